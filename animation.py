@@ -0,0 +1,108 @@
+'''
+Keyframe animations. A Track is a loop of (glyph, color) keyframes, each held for the same number of ticks;
+an Animator plays tracks on the entities of one World. Frames follow the world's clock, not the moment a track
+started, so every entity playing the same track shows the same frame.
+
+Nothing runs between keyframes: playing a track applies its current frame and schedules a callback on the
+world's Scheduler for the next boundary, which applies the next frame (touching the entity so it is drawn
+again) and schedules the one after. An entity that is out of sight at a boundary is paused instead, and picks
+up the frame it should be showing once it is visible again.
+'''
+
+
+class Track(object):
+    '''
+    frames is a list of (glyph, color handle), a None leaves that channel to the entity. The frame showing at
+    tick t is frames[t // period % len(frames)].
+    '''
+
+    def __init__(self, frames, period=1):
+        self.frames = frames
+        self.period = period
+
+    def frame_at(self, tick):
+        return self.frames[tick // self.period % len(self.frames)]
+
+    def next_boundary(self, tick):
+        return (tick // self.period + 1) * self.period
+
+
+class Animator(object):
+    '''
+    Animations of one World. Entities show the result through their glyph and tint attributes; when several
+    tracks play on an entity, the one started last wins each channel it sets.
+    '''
+
+    def __init__(self, world):
+        self.world = world
+        self.playing = {} #entity -> {name: (track, token)}
+        self.paused = {} #entity -> names waiting for the entity to be visible again
+        self.tokens = 0 #callbacks of a stopped or restarted track find their token gone and do nothing
+
+    def is_playing(self, e, name):
+        return name in self.playing.get(e, ())
+
+    def play(self, e, name, track):
+        '''Starts (or restarts) track on e under name.'''
+        self.tokens += 1
+        self.playing.setdefault(e, {})[name] = (track, self.tokens)
+        self._discard_paused(e, name)
+        self._apply(e)
+        self._schedule(e, name)
+
+    def stop(self, e, name):
+        tracks = self.playing.get(e)
+        if tracks is None or name not in tracks:
+            return
+        tracks.pop(name)
+        if not tracks:
+            self.playing.pop(e)
+        self._discard_paused(e, name)
+        self._apply(e)
+
+    def stop_all(self, e):
+        if self.playing.pop(e, None) is not None:
+            self.paused.pop(e, None)
+            self._apply(e)
+
+    def _discard_paused(self, e, name):
+        names = self.paused.get(e)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                self.paused.pop(e)
+
+    def _apply(self, e):
+        glyph = tint = None
+        now = self.world.scheduler.now
+        for track, token in self.playing.get(e, {}).values():
+            g, c = track.frame_at(now)
+            if g is not None:
+                glyph = g
+            if c is not None:
+                tint = c
+        if glyph != e.glyph or tint != e.tint:
+            e.glyph, e.tint = glyph, tint
+            e.touch()
+
+    def _schedule(self, e, name):
+        track, token = self.playing[e][name]
+        scheduler = self.world.scheduler
+        scheduler.call_at(track.next_boundary(scheduler.now), lambda: self._boundary(e, name, token))
+
+    def _boundary(self, e, name, token):
+        tracks = self.playing.get(e)
+        if tracks is None or name not in tracks or tracks[name][1] != token:
+            return
+        if e.get_pos() not in self.world.visible:
+            self.paused.setdefault(e, set()).add(name)
+            return
+        self._apply(e)
+        self._schedule(e, name)
+
+    def resume(self, visible):
+        '''Restarts the paused tracks of every entity in visible. World.update calls this once per tick.'''
+        for e in [e for e in self.paused if e in visible]:
+            for name in self.paused.pop(e):
+                self._apply(e)
+                self._schedule(e, name)
@@ -0,0 +1,136 @@
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+
+
+class NullBackend(object):
+    '''Swallows every utterance.'''
+
+    def speak(self, text, voice):
+        pass
+
+
+class SubprocessBackend(object):
+    '''Runs the speech command directly (no shell) and waits for it to finish.'''
+
+    def __init__(self, command='say'):
+        self.command = command
+
+    def speak(self, text, voice):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([self.command, '-v', voice, text], stdout=devnull, stderr=devnull)
+
+
+class RecordingBackend(object):
+    '''Keeps every utterance in order, useful when checking what the game said.'''
+
+    def __init__(self):
+        self.spoken = []
+
+    def speak(self, text, voice):
+        self.spoken.append((text, voice))
+
+
+class AudioDispatcher(object):
+    '''
+    Single worker thread fed by a bounded queue. say() never blocks the caller:
+    identical utterances already waiting are dropped, identical utterances said
+    less than min_interval seconds ago are dropped, and when the queue is full
+    the oldest pending utterance makes room for the new one.
+    '''
+
+    def __init__(self, backend=None, max_pending=8, min_interval=1.0, clock=time.time):
+        if backend is None:
+            backend = SubprocessBackend()
+        self.backend = backend
+        self.max_pending = max_pending
+        self.min_interval = min_interval
+        self.clock = clock
+
+        self.pending = deque()
+        self.last_said = {}
+        self.busy = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.worker = None
+
+    @staticmethod
+    def get_instance():
+        if not hasattr(AudioDispatcher, '_instance'):
+            AudioDispatcher._instance = AudioDispatcher()
+        return AudioDispatcher._instance
+
+    def set_backend(self, backend):
+        with self.cond:
+            self.backend = backend
+
+    def say(self, text, voice='veena'):
+        '''Queue an utterance. Returns False if it was deduplicated or rate limited.'''
+        key = (text, voice)
+        now = self.clock()
+        with self.cond:
+            if self.closed or isinstance(self.backend, NullBackend):
+                return False
+            last = self.last_said.get(key)
+            if last is not None and now - last < self.min_interval:
+                return False
+            if key in self.pending:
+                return False
+
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+            self.pending.append(key)
+            self.last_said[key] = now
+
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run)
+                self.worker.daemon = True
+                self.worker.start()
+            self.cond.notify()
+        return True
+
+    def flush(self, timeout=None):
+        '''Block until everything queued so far has been spoken.'''
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.cond:
+            while self.pending or self.busy:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+        return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    self.busy = False
+                    self.cond.notify_all()
+                    return
+                text, voice = self.pending.popleft()
+                backend = self.backend
+                self.busy = True
+
+            try:
+                backend.speak(text, voice)
+            except OSError: #speech command missing, stay quiet from now on
+                with self.cond:
+                    self.backend = NullBackend()
+                    self.pending.clear()
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
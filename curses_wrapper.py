@@ -1,5 +1,6 @@
 import curses 
 from collections import defaultdict
+from keyinput import InputReader
 
 color_map = {
 'white':curses.COLOR_WHITE,
@@ -45,6 +46,9 @@ class Pair():
             return self.x
         raise IndexError("No.")
 
+    def __lt__(self, other):
+        return (self.y, self.x) < (other.y, other.x)
+
     def __hash__(self):
         return (self.y,self.x).__hash__()
 
@@ -264,9 +268,13 @@ class DrawController():
 '''Really simple keyboard controller. Provided bare minimum, class designed to be added to as necessary.'''
 class KeyboardController():
 
-    def __init__(self, screen):
+    def __init__(self, screen, reader=None):
         self.screen = screen
         self.callbacks = defaultdict(set)
+        if reader is None:
+            reader = InputReader()
+            reader.start()
+        self.reader = reader
 
     def register_keys(self, keyset, callback):
         '''
@@ -276,19 +284,14 @@ class KeyboardController():
         for k in keyset:
             self.callbacks[ord(k)].add(callback)
 
-    def getkeys(self): #order not guaranteed
-        pressed = set()
-        char = self.screen.getch()
-        while True:
-            if char != -1:
-                pressed.add(char)
-            else:
-                break
-            char = self.screen.getch()
+    def getkeys(self):
+        '''Calls back for every key pressed since the last call, in the order they were pressed.'''
+        for ev in self.reader.get_events():
+            for h in self.callbacks.get(ev.key, ()):
+                h(ev.key)
 
-        for k in pressed:
-            for h in self.callbacks[k]:
-                h(k)
+    def stop(self):
+        self.reader.stop()
 
 if __name__ == '__main__':
 
@@ -309,7 +312,7 @@ if __name__ == '__main__':
             (y+1,x+2),
             (y+2,x+1)
             ]
-            active = map(lambda p:Pair(p[0],p[1]), active)
+            active = [Pair(p[0],p[1]) for p in active]
             while True:
                 for a in active:
                     c = Char(a, ' ', color=CC.get_color("white","white"))
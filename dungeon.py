@@ -1,19 +1,19 @@
 import random
 
-def weird_dungeon(height, width, enemy_density=.5, powerup_density = .2):
+def weird_dungeon(height, width, enemy_density=.5, powerup_density = .2, rng=random):
     gr = [[0]*width for i in range(height)]
     rooms = []
     def helper(gr, rooms, lowx, lowy, highx, highy):
         if highx-lowx <= 3 or highy - lowy <= 3:
             return 
 
-        width,height = random.randint(3, highx-lowx-1), random.randint(3, highy-lowy-1)
-        px, py = random.randint(lowx, highx-width-1), random.randint(lowy, highy-height-1)
+        width,height = rng.randint(3, highx-lowx-1), rng.randint(3, highy-lowy-1)
+        px, py = rng.randint(lowx, highx-width-1), rng.randint(lowy, highy-height-1)
         rooms.append((py, px, py+height, px+width))
 
         removed = [1]*(width * 2 + height * 2)
         for i in range(max(int(len(removed)/20.), 5)):
-            removed[random.randint(0,len(removed)-1)] = 0
+            removed[rng.randint(0,len(removed)-1)] = 0
 
         for i in range(px, px+width):
             if removed.pop():
@@ -48,18 +48,18 @@ def weird_dungeon(height, width, enemy_density=.5, powerup_density = .2):
     enemies = []
     power_ups = []
     for k in range(int(len(rooms)*enemy_density + 1)):
-        room = random.choice(rooms)
+        room = rng.choice(rooms)
         ly, lx, hy, hx = room
 
-        py, px = random.randint(ly+1,hy-2), random.randint(lx+1, hx-2)
+        py, px = rng.randint(ly+1,hy-2), rng.randint(lx+1, hx-2)
 
         enemies.append((py, px))
 
     for k in range(int(len(rooms)*powerup_density + 1)):
-        room = random.choice(rooms)
+        room = rng.choice(rooms)
         ly, lx, hy, hx = room
 
-        py, px = random.randint(ly+1,hy-2), random.randint(lx+1, hx-2)
+        py, px = rng.randint(ly+1,hy-2), rng.randint(lx+1, hx-2)
 
         power_ups.append((py, px))
 
@@ -0,0 +1,138 @@
+import curses
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+
+ESC = 27
+
+_final_keys = {
+ord('A'):curses.KEY_UP,
+ord('B'):curses.KEY_DOWN,
+ord('C'):curses.KEY_RIGHT,
+ord('D'):curses.KEY_LEFT,
+ord('H'):curses.KEY_HOME,
+ord('F'):curses.KEY_END,
+}
+
+
+class KeyEvent(object):
+    def __init__(self, key, time):
+        self.key = key
+        self.time = time
+
+    def __str__(self):
+        return '[KeyEvent: %s @%.3f]'%(self.key, self.time)
+
+
+class KeyDecoder(object):
+    '''Incrementally turns raw terminal bytes into key codes, arrow escape sequences become curses.KEY_* values.'''
+
+    def __init__(self):
+        self.state = 0 #0 plain, 1 after ESC, 2 inside a CSI/SS3 sequence
+        self.params = []
+
+    def feed(self, data):
+        keys = []
+        for b in bytearray(data):
+            if self.state == 0:
+                if b == ESC:
+                    self.state = 1
+                else:
+                    keys.append(b)
+            elif self.state == 1:
+                if b == ord('[') or b == ord('O'):
+                    self.state = 2
+                    self.params = []
+                else:
+                    keys.append(ESC)
+                    self.state = 0
+                    if b == ESC:
+                        self.state = 1
+                    else:
+                        keys.append(b)
+            else:
+                if 0x40 <= b <= 0x7e:
+                    if b in _final_keys:
+                        keys.append(_final_keys[b])
+                    self.state = 0
+                else:
+                    self.params.append(b)
+        return keys
+
+    def has_pending(self):
+        return self.state != 0
+
+    def flush(self):
+        '''A lone ESC that was never followed by a sequence is the escape key itself.'''
+        keys = [ESC] if self.state == 1 else []
+        self.state = 0
+        return keys
+
+
+class InputReader(object):
+    '''
+    Reads stdin on its own thread and timestamps each key into a deque. The deque is only appended to by the
+    reader and only popped by the game loop, both of which are atomic, so no lock is needed.
+    Without start() the same work can be done synchronously by calling poll() once per frame.
+    '''
+
+    def __init__(self, fd=None, clock=time.time, esc_timeout=.05):
+        if fd is None:
+            fd = sys.stdin.fileno()
+        self.fd = fd
+        self.clock = clock
+        self.esc_timeout = esc_timeout
+        self.decoder = KeyDecoder()
+        self.events = deque()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(1)
+            self.thread = None
+
+    def _push(self, keys):
+        now = self.clock()
+        for k in keys:
+            self.events.append(KeyEvent(k, now))
+
+    def _read(self, timeout):
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            if self.decoder.has_pending():
+                self._push(self.decoder.flush())
+            return False
+        data = os.read(self.fd, 1024)
+        if not data:
+            self.running = False
+            return False
+        self._push(self.decoder.feed(data))
+        return True
+
+    def _run(self):
+        while self.running:
+            self._read(self.esc_timeout)
+
+    def poll(self):
+        '''Synchronously drain whatever is waiting on stdin.'''
+        while self._read(0):
+            pass
+
+    def get_events(self):
+        '''Pop every event received so far, oldest first.'''
+        res = []
+        events = self.events
+        while events:
+            res.append(events.popleft())
+        return res
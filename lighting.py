@@ -0,0 +1,133 @@
+'''
+Light map. Any awake entity whose get_light() returns (radius, intensity) is a light source; its light is cast
+over the walls out to radius and falls off with distance. Each source's contribution is cached together with
+what it depends on (where the source is, its radius and intensity, and the walls in its range), so a light
+that stays put costs nothing per frame: only sources that moved or changed, or whose walls changed, are cast
+again and their difference applied to the per cell totals. Totals are integers, so nothing drifts however
+often a contribution is taken back out.
+
+Levels index into a list of color handles, see MainController for the ones the game uses.
+'''
+from util import OPAQUE
+
+FULL = 1000 #total that counts as fully lit
+
+
+class LightMap(object):
+    '''
+    Lighting for one World. Call update() once per frame after the world updated, it returns the cells whose
+    light level changed. shades holds a color handle per level, darkest first.
+    '''
+
+    def __init__(self, world, shades, falloff=1.):
+        self.world = world
+        self.shades = shades
+        self.falloff = falloff
+        self.rays = world.rays
+
+        size = len(self.rays.new_grid())
+        self.walls = None
+        self.totals = [0] * size
+        self.levels = bytearray(size)
+        self.cache = {} #source -> ((y, x, radius, intensity), {grid index: amount})
+        self.curves = {} #radius -> amount of light at full intensity per squared distance
+
+    def _curve(self, r):
+        curve = self.curves.get(r)
+        if curve is None:
+            curve = self.curves[r] = [FULL * max(0., 1 - d**.5 / (r + 1))**self.falloff for d in range(r * r + 1)]
+        return curve
+
+    def _occluders(self):
+        '''The world's walls, dormant or woken, and which cached sources they changed for since the last frame.'''
+        world = self.world
+        rays = self.rays
+        if world.static_opaque is None:
+            world.occupancy()
+        walls = bytearray(world.static_opaque)
+        for e in world.awake:
+            if e.is_dormant() and not e.is_transparent():
+                p = e.get_pos()
+                if world.pos_in_world(p):
+                    walls[rays.index(p.y, p.x)] = OPAQUE
+
+        stale = set()
+        old = self.walls
+        self.walls = walls
+        if old is None or old == walls:
+            return walls, stale
+        stride = rays.stride
+        changed = []
+        for row in range(0, len(walls), stride):
+            if old[row:row + stride] != walls[row:row + stride]:
+                changed.extend(i for i in range(row, row + stride) if old[i] != walls[i])
+        for e, ((y, x, r, v), contrib) in self.cache.items():
+            for i in changed:
+                p = rays.pos(i)
+                if abs(p.y - y) <= r and abs(p.x - x) <= r:
+                    stale.add(e)
+                    break
+        return walls, stale
+
+    def _cast(self, walls, y, x, r, intensity):
+        curve = self._curve(r)
+        res = {}
+        for i, d in self.rays.cast(walls, y, x, r).items():
+            v = int(curve[d] * intensity)
+            if v > 0:
+                res[i] = v
+        return res
+
+    def update(self):
+        walls, stale = self._occluders()
+        totals = self.totals
+        touched = set()
+        cache = self.cache
+        lit = set()
+        for e in self.world.awake:
+            light = e.get_light()
+            if light is None:
+                continue
+            lit.add(e)
+            r, intensity = light
+            p = e.get_pos()
+            key = (p.y, p.x, min(r, self.rays.radius), intensity)
+            cached = cache.get(e)
+            if cached is not None:
+                if cached[0] == key and e not in stale:
+                    continue
+                for i, v in cached[1].items():
+                    totals[i] -= v
+                touched.update(cached[1])
+            if self.world.pos_in_world(p):
+                contrib = self._cast(walls, key[0], key[1], key[2], intensity)
+            else:
+                contrib = {}
+            cache[e] = (key, contrib)
+            for i, v in contrib.items():
+                totals[i] += v
+            touched.update(contrib)
+
+        for e in [e for e in cache if e not in lit]:
+            contrib = cache.pop(e)[1]
+            for i, v in contrib.items():
+                totals[i] -= v
+            touched.update(contrib)
+
+        levels = self.levels
+        top = len(self.shades) - 1
+        pos = self.rays.pos
+        changed = []
+        for i in touched:
+            lv = min(top, (totals[i] * top + FULL // 2) // FULL)
+            if lv != levels[i]:
+                levels[i] = lv
+                changed.append(pos(i))
+        return changed
+
+    def level(self, p):
+        return self.levels[self.rays.index(p.y, p.x)]
+
+    def color_at(self, p):
+        '''Color handle for the light at p, usable as the color of a DrawController rule.'''
+        return self.shades[self.levels[self.rays.index(p.y, p.x)]]
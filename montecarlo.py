@@ -0,0 +1,302 @@
+'''
+Batch balancing runs. Thousands of headless games, each its own World with its own Random, played by a scripted
+Bot and spread over a process pool. Every game is a pure function of its seed and settings, so any game in a run
+can be played again on its own.
+
+Results stream into a directory with one file per column, values in native byte order:
+    columns     one "name typecode" line per column, typecodes as in the array module
+    NAME.bin    the values of column NAME, one per game, except hp which holds every game's samples back to back
+                (hp_count says how many belong to each game)
+
+    python montecarlo.py OUT_DIR [--games N] [--procs P] [--enemy .3,.5] [--powerup .1,.2] [--durations 1,.5]
+'''
+import curses
+import itertools
+import os
+import random
+import sys
+from array import array
+from multiprocessing import Pool
+from time import time
+
+from audio import AudioDispatcher, NullBackend
+from util import Pair, UP, RIGHT, DOWN, LEFT, OPEN
+from terminal_engine import World, Player, Spooker, Potion, build_level, powerup_durations, VIEW_RADIUS
+
+DIED = 0
+CLEARED = 1
+TIMED_OUT = 2
+
+COLUMNS = [
+    ('seed', 'Q'),
+    ('enemy_density', 'd'),
+    ('powerup_density', 'd'),
+    ('duration_scale', 'd'),
+    ('outcome', 'B'),
+    ('ticks', 'I'),
+    ('kills', 'H'),
+    ('spookers', 'H'),
+    ('hp_count', 'H'),
+    ('hp', 'h'),
+]
+
+_direction_keys = {UP:curses.KEY_UP, DOWN:curses.KEY_DOWN, LEFT:curses.KEY_LEFT, RIGHT:curses.KEY_RIGHT}
+_fire_key = ord(' ')
+
+
+class Bot(object):
+    '''
+    Scripted player that presses the same keys a person would. It backs off from a Spooker right next to it, fires
+    at the nearest visible one once lined up and facing it with a clear shot, and otherwise walks a shortest path
+    around the walls toward the nearest visible Spooker, visible potion or, failing those, any Spooker. Paths to
+    a Spooker out of sight go over world.rooms when the level has one, a waypoint at a time.
+    '''
+
+    def __init__(self, rng, replan=8):
+        self.rng = rng
+        self.replan = replan #steps taken along a path before looking for a new one
+        self.path = []
+        self.waypoints = [] #coarse route from world.rooms, next one last
+        self.steps = 0
+
+    def keys(self, world, player):
+        me = player.get_pos()
+        visible = world.visible
+        seen = [s.get_pos() for s in world.within_radius(me, VIEW_RADIUS, Spooker) if s.get_pos() in visible]
+        if seen:
+            t = min(seen, key=me.dist2)
+            if me.dist2(t) < 4: #too close to shoot, back off
+                self.path = []
+                return [_direction_keys[(me.direction_to(t) + 2) % 4]]
+            if (t.y == me.y or t.x == me.x) and world.line_of_sight(me, t):
+                d = me.direction_to(t)
+                if player.get_last_direction() != d:
+                    return [_direction_keys[d]]
+                return [_fire_key] if player.get_rof_timer() == 0 else []
+
+        if player.get_rom_timer() != 0:
+            return []
+        if not self.path and self.waypoints and self.steps < self.replan:
+            self.path = self._refine(world, me)
+        if not self.path or self.steps >= self.replan:
+            targets = seen
+            if not targets:
+                targets = [p.get_pos() for p in world.within_radius(me, VIEW_RADIUS, Potion) if p.get_pos() in visible]
+            self.waypoints = []
+            if not targets and world.rooms is not None:
+                far = [s.get_pos() for s in world.get_all_of_type(Spooker)]
+                if far:
+                    self.waypoints = world.rooms.route(me, min(far, key=me.dist2)) or []
+                    self.waypoints.reverse()
+                self.path = self._refine(world, me)
+            if not self.path:
+                if not targets:
+                    targets = [s.get_pos() for s in world.get_all_of_type(Spooker)]
+                self.path = self._route(world, me, targets)
+            self.steps = 0
+        if not self.path:
+            return [_direction_keys[self.rng.randrange(4)]]
+        self.steps += 1
+        return [_direction_keys[me.direction_to(self.path.pop())]]
+
+    def _refine(self, world, start):
+        '''Path to the next waypoint, next cell last; empty once the waypoints are used up or lead nowhere.'''
+        if not self.waypoints:
+            return []
+        path = world.rooms.refine(start, self.waypoints.pop())
+        if path is None:
+            self.waypoints = []
+            return []
+        path.reverse()
+        return path
+
+    def _route(self, world, start, targets):
+        '''Breadth first search over the walls, returns the cells to walk through, next one last.'''
+        rays = world.rays
+        if world.static_opaque is None:
+            world.occupancy()
+        grid = world.static_opaque
+        goal = set(rays.index(p.y, p.x) for p in targets)
+        first = rays.index(start.y, start.x)
+        steps = (-rays.stride, 1, rays.stride, -1)
+        prev = {first:None}
+        frontier = [first]
+        while frontier:
+            nxt = []
+            for i in frontier:
+                if i in goal:
+                    path = []
+                    while i != first:
+                        path.append(rays.pos(i))
+                        i = prev[i]
+                    return path
+                for d in steps:
+                    n = i + d
+                    if n not in prev and grid[n] == OPEN:
+                        prev[n] = i
+                        nxt.append(n)
+            frontier = nxt
+        return []
+
+
+def play(seed, enemy_density=.5, powerup_density=.2, duration_scale=1., height=60, width=180, max_ticks=20000,
+        sample_every=100):
+    '''Plays one game to the end and returns its row, see COLUMNS.'''
+    rng = random.Random(seed)
+    world = World(height, width, rng=rng)
+    world.powerup_durations = dict((t, max(1, int(d * duration_scale))) for t, d in powerup_durations.items())
+    build_level(world, random.Random('%d:0' % seed), enemy_density, powerup_density)
+    player = Player(Pair(height // 2, width // 2))
+    world.add(player, first=True)
+    world.reindex()
+    world.calc_visibility()
+
+    bot = Bot(rng)
+    handlers = world.ctx.key_handlers
+    spookers = left = len(world.get_all_of_type(Spooker))
+    hp = array('h')
+    outcome = TIMED_OUT
+    tick = 0
+    while tick < max_ticks:
+        if tick % sample_every == 0:
+            hp.append(player.get_hp())
+        table = handlers.get_table()
+        for k in bot.keys(world, player):
+            for h in table.get(k, ()):
+                h.callback(h.key)
+        world.update()
+        world.calc_visibility()
+        tick += 1
+
+        if player.is_dead():
+            outcome = DIED
+            break
+        left = len(world.get_all_of_type(Spooker))
+        if not left:
+            outcome = CLEARED
+            break
+    hp.append(player.get_hp())
+
+    return {'seed':seed, 'enemy_density':enemy_density, 'powerup_density':powerup_density,
+        'duration_scale':duration_scale, 'outcome':outcome, 'ticks':tick, 'kills':spookers - left,
+        'spookers':spookers, 'hp_count':len(hp), 'hp':hp}
+
+
+class ColumnWriter(object):
+    '''Buffers rows column by column and appends them to the column files every flush_every rows.'''
+
+    def __init__(self, directory, columns=COLUMNS, flush_every=256):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.columns = columns
+        self.flush_every = flush_every
+        self.pending = 0
+        self.rows = 0
+        self.buffers = dict((name, array(code)) for name, code in columns)
+        with open(os.path.join(directory, 'columns'), 'w') as f:
+            for name, code in columns:
+                f.write('%s %s\n' % (name, code))
+        for name, code in columns:
+            open(self._path(name), 'wb').close()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def write(self, row):
+        for name, code in self.columns:
+            v = row[name]
+            if isinstance(v, array):
+                self.buffers[name].extend(v)
+            else:
+                self.buffers[name].append(v)
+        self.rows += 1
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for name, code in self.columns:
+            buf = self.buffers[name]
+            with open(self._path(name), 'ab') as f:
+                buf.tofile(f)
+            del buf[:]
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+
+
+def read_columns(directory):
+    '''Returns name -> array for a directory written by ColumnWriter.'''
+    res = {}
+    with open(os.path.join(directory, 'columns')) as f:
+        for line in f:
+            name, code = line.split()
+            col = array(code)
+            with open(os.path.join(directory, name + '.bin'), 'rb') as data:
+                col.frombytes(data.read())
+            res[name] = col
+    return res
+
+
+def _init_worker():
+    AudioDispatcher.get_instance().set_backend(NullBackend())
+
+
+def _play_job(job):
+    seed, enemy_density, powerup_density, duration_scale, max_ticks = job
+    return play(seed, enemy_density, powerup_density, duration_scale, max_ticks=max_ticks)
+
+
+def run(directory, games, enemy_densities=(.5,), powerup_densities=(.2,), duration_scales=(1.,), processes=None,
+        seed=0, max_ticks=20000):
+    '''
+    Plays games games for every combination of settings, seeds seed, seed+1, ... in the order the combinations
+    come, and streams the rows to directory as they finish. Returns (games played, seconds, cores used).
+    '''
+    processes = processes or os.cpu_count() or 1
+    settings = itertools.product(enemy_densities, powerup_densities, duration_scales)
+    jobs = [(seed + i * games + g, e, p, d, max_ticks) for i, (e, p, d) in enumerate(settings) for g in range(games)]
+
+    writer = ColumnWriter(directory)
+    start = time()
+    if processes == 1:
+        _init_worker()
+        for job in jobs:
+            writer.write(_play_job(job))
+    else:
+        pool = Pool(processes, initializer=_init_worker)
+        try:
+            for row in pool.imap_unordered(_play_job, jobs, chunksize=max(1, len(jobs) // (processes * 8))):
+                writer.write(row)
+        finally:
+            pool.terminate()
+            pool.join()
+    writer.close()
+    return writer.rows, time() - start, min(processes, os.cpu_count() or 1)
+
+
+def _floats(flag, default):
+    if flag in sys.argv[:-1]:
+        return tuple(float(v) for v in sys.argv[sys.argv.index(flag) + 1].split(','))
+    return default
+
+
+def _int(flag, default):
+    if flag in sys.argv[:-1]:
+        return int(sys.argv[sys.argv.index(flag) + 1])
+    return default
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1].startswith('--'):
+        print('usage: python montecarlo.py OUT_DIR [--games N] [--procs P] [--seed S] [--max-ticks T] '
+            '[--enemy .3,.5] [--powerup .1,.2] [--durations 1,.5]')
+        sys.exit(2)
+    count, spent, cores = run(sys.argv[1], _int('--games', 100),
+        enemy_densities=_floats('--enemy', (.5,)), powerup_densities=_floats('--powerup', (.2,)),
+        duration_scales=_floats('--durations', (1.,)), processes=_int('--procs', None),
+        seed=_int('--seed', 0), max_ticks=_int('--max-ticks', 20000))
+    rate = count / max(spent, 1e-9)
+    print('%d games in %.1fs, %.2f games/s, %.2f games/s per core' % (count, spent, rate, rate / cores))
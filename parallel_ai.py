@@ -0,0 +1,143 @@
+'''
+Two phase monster AI. Before the first Spooker updates, the collision snapshot is copied into a shared memory
+grid and worker processes work out, for partitions of the monsters, which way move_toward/move_away would go
+for every target the monster might pick this tick. Spookers then update serially as before and consume those
+directions instead of evaluating their neighbours.
+
+Collidability of a cell holding a Spooker depends on that Spooker's mood, which can change earlier in the
+same tick, so such cells are marked uncertain. A monster whose choice depends on an uncertain cell gets no
+planned direction and falls back to the serial code, which keeps the outcome identical to a serial tick.
+'''
+import os
+from multiprocessing import Pool, shared_memory
+
+FREE = 0
+BLOCKED = 1
+UNCERTAIN = 2
+
+TOWARD = 0
+AWAY = 1
+
+_offsets = [(-1, 0), (0, 1), (1, 0), (0, -1)] #same order as Pair.get_neighbors
+
+_grid = None
+
+
+def _attach(name):
+    global _grid
+    _grid = shared_memory.SharedMemory(name=name)
+
+
+def _choose(grid, height, width, y, x, ty, tx, kind):
+    '''Returns the direction index, -1 to stay put, or None when an uncertain cell takes part.'''
+    best = None
+    best_d = None
+    for d in range(4):
+        ny, nx = y + _offsets[d][0], x + _offsets[d][1]
+        if 0 <= ny < height and 0 <= nx < width:
+            cell = grid[ny * width + nx]
+            if cell == UNCERTAIN:
+                return None
+            if cell == BLOCKED:
+                continue
+        dis = (ny - ty)**2 + (nx - tx)**2 #squared, orders the same as the distance itself
+        if best is None or (dis < best_d if kind == TOWARD else dis > best_d):
+            best, best_d = d, dis
+
+    if best is None:
+        return None if kind == TOWARD else -1
+    if kind == TOWARD and (y - ty)**2 + (x - tx)**2 < best_d:
+        return -1
+    return best
+
+
+def _plan_chunk(args):
+    height, width, jobs = args
+    grid = _grid.buf
+    res = []
+    for i, y, x, targets in jobs:
+        plan = {}
+        for kind, ty, tx in targets:
+            d = _choose(grid, height, width, y, x, ty, tx, kind)
+            if d is not None:
+                plan[(kind, ty, tx)] = d
+        res.append((i, plan))
+    return res
+
+
+class AIPool(object):
+    '''
+    Attach with World.set_ai(AIPool(world.height, world.width)). Below threshold monsters the planning is skipped
+    and everything stays serial, since shipping the work to other processes costs more than it saves.
+    '''
+
+    def __init__(self, height, width, processes=None, threshold=64):
+        self.height = height
+        self.width = width
+        self.threshold = threshold
+        self.shm = shared_memory.SharedMemory(create=True, size=height * width)
+        self.grid = bytearray(height * width)
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = Pool(self.processes, initializer=_attach, initargs=(self.shm.name,))
+        self.planned = []
+
+    def _fill_grid(self, snapshot, spookers):
+        grid = self.grid
+        grid[:] = bytes(len(grid))
+        width = self.width
+        for pos, ents in snapshot.items():
+            if not (0 <= pos.y < self.height and 0 <= pos.x < width):
+                continue
+            state = FREE
+            for e in ents:
+                if e in spookers:
+                    if state == FREE:
+                        state = UNCERTAIN
+                elif e.is_collidable():
+                    state = BLOCKED
+                    break
+            grid[pos.y * width + pos.x] = state
+        self.shm.buf[:len(grid)] = grid
+
+    def plan(self, world, player_pos, spookers):
+        '''
+        Sets unit.plan on every one of spookers, the world's Spookers. World.update passes them in so the classes
+        used are those of the running engine. Call finish() once they have all updated.
+        '''
+        if len(spookers) < self.threshold:
+            return
+        self._fill_grid(world.snapshot(), set(spookers))
+
+        py, px = player_pos
+        jobs = []
+        for i, s in enumerate(spookers):
+            if s.get_rom_timer() != 0: #cooling down, it will not move whatever we plan
+                continue
+            y, x = s.get_pos()
+            #the player, or the patrol point: the current one, or the first one for a freshly bored monster
+            targets = [(TOWARD, py, px), (AWAY, py, px), (TOWARD, s.pth[0].y, s.pth[0].x)]
+            pthindex = getattr(s.moodController.mood, 'pthindex', 0) #only a BoredMood patrols
+            if pthindex != 0:
+                t = s.pth[pthindex]
+                targets.append((TOWARD, t.y, t.x))
+            jobs.append((i, y, x, targets))
+
+        if not jobs:
+            return
+        size = (len(jobs) + self.processes - 1) // self.processes
+        chunks = [(self.height, self.width, jobs[k:k + size]) for k in range(0, len(jobs), size)]
+        for chunk in self.pool.map(_plan_chunk, chunks):
+            for i, plan in chunk:
+                spookers[i].plan = plan
+        self.planned = spookers
+
+    def finish(self):
+        for s in self.planned:
+            s.plan = None
+        self.planned = []
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.shm.close()
+        self.shm.unlink()
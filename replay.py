@@ -0,0 +1,158 @@
+'''
+Lockstep recordings of a game: the seed plus the keys consumed on every tick, with a hash of the world after
+each tick so a replay can tell exactly where it diverged.
+
+Log format, gzip compressed:
+    header      HEADER (magic, version, seed, world height, world width)
+    per tick    varint key count, varint keys, uint32 state hash
+'''
+import gzip
+import struct
+import sys
+import zlib
+from time import time
+
+from keyinput import KeyEvent
+from terminal_engine import MainController, Wall, new_game, TIME_UNIT
+
+MAGIC = b'TERP'
+VERSION = 3
+HEADER = struct.Struct('<4sHQHH')
+HASH = struct.Struct('<I')
+
+
+class ReplayError(Exception):
+    pass
+
+
+def _put_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _get_varint(f):
+    shift = res = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            raise EOFError()
+        b = ord(b)
+        res |= (b & 0x7f) << shift
+        if b < 0x80:
+            return res
+        shift += 7
+
+
+def state_hash(world):
+    '''crc32 over everything that moves. Static walls only contribute their count.'''
+    h = 0
+    walls = 0
+    for e in world.entities:
+        if type(e) is Wall:
+            walls += 1
+            continue
+        y, x = e.get_pos()
+        h = zlib.crc32(('%s %d %d %d;' % (type(e).__name__, y, x, getattr(e, 'hp', 0))).encode(), h)
+    return zlib.crc32(('%d %d' % (walls, world.visibility_dis)).encode(), h)
+
+
+class Recorder(object):
+    def __init__(self, path, seed, height, width):
+        self.f = gzip.open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION, seed, height, width))
+        self.ticks = 0
+
+    def record(self, keys, world):
+        buf = bytearray()
+        _put_varint(buf, len(keys))
+        for k in keys:
+            _put_varint(buf, k)
+        buf += HASH.pack(state_hash(world))
+        self.f.write(buf)
+        self.ticks += 1
+
+    def close(self):
+        self.f.close()
+
+
+def read_log(path):
+    '''Returns ((seed, height, width), iterator of (keys, state hash) per tick).'''
+    f = gzip.open(path, 'rb')
+    head = f.read(HEADER.size)
+    if len(head) != HEADER.size:
+        raise ReplayError('Truncated replay header')
+    magic, version, seed, height, width = HEADER.unpack(head)
+    if magic != MAGIC:
+        raise ReplayError('Not a replay log')
+    if version != VERSION:
+        raise ReplayError('Unsupported replay version %d' % version)
+
+    def ticks():
+        with f:
+            while True:
+                try:
+                    n = _get_varint(f)
+                except EOFError:
+                    return
+                keys = [_get_varint(f) for i in range(n)]
+                yield keys, HASH.unpack(f.read(HASH.size))[0]
+    return (seed, height, width), ticks()
+
+
+class ReplayInput(object):
+    '''Input source for MainController that hands out the recorded keys of the current tick.'''
+    def __init__(self):
+        self.pending = []
+        self.tick = 0
+
+    def clock(self):
+        return self.tick * TIME_UNIT
+
+    def feed(self, keys):
+        self.pending = keys
+        self.tick += 1
+
+    def get_events(self):
+        now = self.clock()
+        res = [KeyEvent(k, now) for k in self.pending]
+        self.pending = []
+        return res
+
+    def stop(self):
+        pass
+
+
+def replay(path, verify=True):
+    '''
+    Re-runs a recorded game headless and as fast as possible.
+    Returns (ticks run, seconds spent, first tick whose state hash differed or None).
+    '''
+    (seed, height, width), ticks = read_log(path)
+    source = ReplayInput()
+    mc = MainController(world_height=height, world_width=width, headless=True, input_source=source)
+    new_game(mc, seed)
+
+    count = 0
+    mismatch = None
+    start = time()
+    for keys, expected in ticks:
+        source.feed(keys)
+        mc.tock()
+        if verify and mismatch is None and state_hash(mc.w) != expected:
+            mismatch = count
+            break
+        count += 1
+    return count, time() - start, mismatch
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python replay.py LOG [--no-verify]')
+        sys.exit(2)
+    count, spent, mismatch = replay(sys.argv[1], verify='--no-verify' not in sys.argv)
+    print('%d ticks in %.2fs (%.0f ticks/s)' % (count, spent, count / max(spent, 1e-9)))
+    if mismatch is not None:
+        print('Diverged at tick %d' % mismatch)
+        sys.exit(1)
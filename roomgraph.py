@@ -0,0 +1,206 @@
+'''
+Hierarchical pathfinding (HPA*) over the rooms dungeon.weird_dungeon generates. The open cells are cut into
+clusters: cells go with the innermost room containing them, rooms are further cut into tile x tile squares so
+no cluster gets large, and each of those pieces is split into its connected parts. Wherever two clusters touch,
+every run of touching cells becomes one entrance, the pair of cells across the middle of the run. Distances
+between the entrances of each cluster are worked out once, when the graph is built.
+
+A path is first searched for over the entrances and only then walked out cell by cell, a cluster at a time, so
+a long path costs a search over a few hundred entrances plus small searches inside the clusters it crosses
+instead of a search over the whole map.
+
+The walls are taken as they were at generation. Walls only ever go away (see BreakableWall), so a path found
+here stays walkable, if not always the shortest.
+'''
+import heapq
+from array import array
+from collections import defaultdict
+
+from util import Pair
+
+TILE = 16
+
+
+class RoomGraph(object):
+    '''walls is the grid weird_dungeon returns (truthy for a wall), rooms its (y0, x0, y1, x1) rectangles.'''
+
+    def __init__(self, walls, rooms=(), tile=TILE):
+        height, width = len(walls), len(walls[0])
+        self.height = height
+        self.width = width
+        self.open = bytearray(0 if c else 1 for row in walls for c in row)
+        self.expansions = 0 #cells and entrances visited by searches so far
+
+        #innermost room per cell: rooms only nest, so painting the larger ones first leaves the smallest on top
+        room_of = array('i', [-1]) * (height * width)
+        by_area = sorted(range(len(rooms)), key=lambda r: -(rooms[r][2] - rooms[r][0]) * (rooms[r][3] - rooms[r][1]))
+        for r in by_area:
+            y0, x0, y1, x1 = rooms[r]
+            x0, x1 = max(x0, 0), min(x1, width - 1) + 1
+            for y in range(max(y0, 0), min(y1, height - 1) + 1):
+                room_of[y * width + x0:y * width + x1] = array('i', [r]) * (x1 - x0)
+
+        cluster = self.cluster = array('i', [-1]) * (height * width)
+        self.cells = [] #cluster -> its cell indexes
+        for i in range(height * width):
+            if not self.open[i] or cluster[i] >= 0:
+                continue
+            c = len(self.cells)
+            key = (room_of[i], i // width // tile, i % width // tile)
+            cluster[i] = c
+            members = [i]
+            for j in members:
+                for n in self._neighbors(j):
+                    if cluster[n] < 0 and (room_of[n], n // width // tile, n % width // tile) == key:
+                        cluster[n] = c
+                        members.append(n)
+            self.cells.append(members)
+
+        self.nodes = defaultdict(list) #cluster -> its entrance cells
+        self.edges = defaultdict(dict) #entrance cell -> {entrance cell: distance}
+        for x in range(width - 1): #entrances across vertical borders, then horizontal ones
+            self._entrances([y * width + x for y in range(height)], 1)
+        for y in range(height - 1):
+            self._entrances([y * width + x for x in range(width)], width)
+
+        for c, nodes in self.nodes.items():
+            for n in nodes:
+                dist = self._search(n, (c,))[0]
+                for m in nodes:
+                    if m != n and m in dist:
+                        self.edges[n][m] = dist[m]
+        self.expansions = 0
+
+    def _neighbors(self, i):
+        width = self.width
+        if i >= width:
+            yield i - width
+        if i % width < width - 1:
+            yield i + 1
+        if i < (self.height - 1) * width:
+            yield i + width
+        if i % width:
+            yield i - 1
+
+    def _entrances(self, line, step):
+        '''Entrances between the cells of line and the cells step further on.'''
+        cluster, is_open = self.cluster, self.open
+        run = []
+        for a in line + [None]:
+            key = None
+            if a is not None and is_open[a] and is_open[a + step] and cluster[a] != cluster[a + step]:
+                key = (cluster[a], cluster[a + step])
+            if run and key != (cluster[run[0]], cluster[run[0] + step]):
+                a0 = run[len(run) // 2]
+                b0 = a0 + step
+                for n, m in ((a0, b0), (b0, a0)):
+                    if n not in self.edges:
+                        self.nodes[cluster[n]].append(n)
+                    self.edges[n][m] = 1
+                run = []
+            if key is not None:
+                run.append(a)
+
+    def _search(self, start, clusters, goal=None):
+        '''Breadth first search from start through the given clusters. Returns (distances, previous cell).'''
+        cluster = self.cluster
+        dist = {start:0}
+        prev = {start:None}
+        frontier = [start]
+        d = 0
+        while frontier:
+            d += 1
+            nxt = []
+            for i in frontier:
+                self.expansions += 1
+                if i == goal:
+                    return dist, prev
+                for n in self._neighbors(i):
+                    if n not in dist and self.open[n] and cluster[n] in clusters:
+                        dist[n] = d
+                        prev[n] = i
+                        nxt.append(n)
+            frontier = nxt
+        return dist, prev
+
+    def _index(self, p):
+        if 0 <= p.y < self.height and 0 <= p.x < self.width and self.open[p.y * self.width + p.x]:
+            return p.y * self.width + p.x
+        return None
+
+    def _pos(self, i):
+        return Pair(i // self.width, i % self.width)
+
+    def route(self, start, goal):
+        '''
+        Waypoints from start to goal: the entrance cells the path passes, then goal itself. Consecutive waypoints
+        lie in the same cluster or in touching ones, see refine. None if goal cannot be reached.
+        '''
+        s, g = self._index(start), self._index(goal)
+        if s is None or g is None:
+            return None
+        cluster, edges = self.cluster, self.edges
+        cs, cg = cluster[s], cluster[g]
+        if cs == cg:
+            return [goal]
+        from_start = self._search(s, (cs,))[0]
+        to_goal = self._search(g, (cg,))[0]
+        goal_nodes = set(n for n in self.nodes[cg] if n in to_goal)
+
+        gy, gx = divmod(g, self.width)
+        width = self.width
+        h = lambda n: abs(n // width - gy) + abs(n % width - gx)
+        best = {s:0}
+        came = {s:None}
+        heap = [(h(s), 0, s)]
+        while heap:
+            f, d, n = heapq.heappop(heap)
+            if d > best[n]:
+                continue
+            self.expansions += 1
+            if n == g:
+                res = []
+                while n != s:
+                    res.append(self._pos(n))
+                    n = came[n]
+                res.reverse()
+                return res
+            steps = list(edges.get(n, {}).items())
+            if n == s:
+                steps += [(m, from_start[m]) for m in self.nodes[cs] if m in from_start]
+            if n in goal_nodes:
+                steps.append((g, to_goal[n]))
+            for m, cost in steps:
+                nd = d + cost
+                if m not in best or nd < best[m]:
+                    best[m] = nd
+                    came[m] = n
+                    heapq.heappush(heap, (nd + h(m), nd, m))
+        return None
+
+    def refine(self, start, goal):
+        '''Cells from start (excluded) to goal (included), searching only the clusters of the two.'''
+        s, g = self._index(start), self._index(goal)
+        if s is None or g is None:
+            return None
+        prev = self._search(s, (self.cluster[s], self.cluster[g]), g)[1]
+        if g not in prev:
+            return None
+        res = []
+        while g != s:
+            res.append(self._pos(g))
+            g = prev[g]
+        res.reverse()
+        return res
+
+    def find_path(self, start, goal):
+        '''The whole path as cells, start excluded, or None. Walkers should rather refine one waypoint at a time.'''
+        waypoints = self.route(start, goal)
+        if waypoints is None:
+            return None
+        res = []
+        at = start
+        for w in waypoints:
+            res += self.refine(at, w)
+            at = w
+        return res
@@ -0,0 +1,302 @@
+'''
+Compact binary snapshots of a World.
+
+Layout (little endian), every section starts at an offset recorded in the header:
+    header      HEADER
+    terrain     height*width bytes, 0 empty, WALL, or BREAKABLE|hp
+    entities    one ENTITY record per non-wall entity, in update order
+    paths       (y, x) int16 pairs referenced by Spooker records
+    buffs       one BUFF record per active buff
+    visible     height*width bits, row major, least significant bit first
+    explored    height*width bits, same layout as visible
+'''
+import mmap
+import os
+import re
+import struct
+from collections import deque
+
+from util import Pair, BitGrid
+from terminal_engine import (World, MobileEntity, Player, Spooker, FastSpooker, Fireball, Wall, BreakableWall, Potion,
+    BoredMood, AngryMood, SpookedMood, Haste, Ghost, Sith, Vision, Lantern)
+
+MAGIC = b'TESN'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHHHHIIIIIIIIII')
+ENTITY = struct.Struct('<BBBxhhiiiiiII')
+PATH_CELL = struct.Struct('<hh')
+BUFF = struct.Struct('<IBxxxii')
+
+WALL = 0x01
+BREAKABLE = 0x10
+
+entity_codes = {Player:1, Spooker:2, FastSpooker:3, Fireball:4, Potion:5}
+mood_codes = {BoredMood:0, AngryMood:1, SpookedMood:2}
+buff_codes = {Haste:1, Ghost:2, Sith:3, Vision:4, Lantern:5}
+
+entity_types = dict((v, k) for k, v in entity_codes.items())
+mood_types = dict((v, k) for k, v in mood_codes.items())
+buff_types = dict((v, k) for k, v in buff_codes.items())
+
+_nonzero = re.compile(b'[^\x00]')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _saved_buff_value(b):
+    if isinstance(b, Haste):
+        return b.old_rom
+    if isinstance(b, Sith):
+        return b.old_base_rof
+    if isinstance(b, Lantern):
+        return b.old_dis
+    return 0
+
+
+def _restore_buff(b, saved):
+    '''Puts a buff back in place without calling apply(), whose effect is already part of the saved state.'''
+    if isinstance(b, Haste):
+        b.old_rom = saved
+    elif isinstance(b, Sith):
+        b.old_base_rof = saved
+    elif isinstance(b, Lantern):
+        b.old_dis = saved
+    elif isinstance(b, Ghost):
+        b.old_f = b.unit.try_move
+        b.unit.try_move = b.unit.absolute_move
+
+
+def _entity_record(e, path_start, path_len):
+    typ = type(e)
+    y, x = e.get_pos()
+    sub, hp, a, b = 0, 0, 0, 0
+    rom_timer, base_rom, last_dir = 0, 0, 0
+    if isinstance(e, MobileEntity):
+        rom_timer, base_rom, last_dir = e.get_rom_timer(), e.get_base_rom(), e.get_last_direction()
+
+    if typ is Player:
+        hp, a, b = e.hp, e.get_rof_timer(), e.base_rof
+    elif typ in (Spooker, FastSpooker):
+        mood = e.moodController.mood
+        sub = mood_codes[type(mood)]
+        hp = e.hp #a is unused since flashing follows the world clock
+        b = mood.pthindex if isinstance(mood, BoredMood) else 0
+    elif typ is Fireball:
+        sub, a, b = e.direction, e.outside_vision_count, int(e.ded)
+    elif typ is Potion:
+        sub, a, b = buff_codes[e.bufftype], e.duration, int(e.applied)
+
+    return ENTITY.pack(entity_codes[typ], sub, last_dir, y, x, hp, rom_timer, base_rom, a, b, path_start, path_len)
+
+
+def save_world(world, path):
+    height, width = world.height, world.width
+    terrain = bytearray(height * width)
+    records, paths, buffs = [], [], []
+    wall_slot = None
+    index = {}
+
+    for e in world.entities:
+        if isinstance(e, Wall):
+            if wall_slot is None:
+                wall_slot = len(records)
+            y, x = e.get_pos()
+            terrain[y * width + x] = BREAKABLE | e.hp if isinstance(e, BreakableWall) else WALL
+            continue
+
+        if type(e) not in entity_codes:
+            raise SnapshotError('Cannot snapshot %s' % type(e).__name__)
+
+        path_start, path_len = len(paths), 0
+        if isinstance(e, Spooker):
+            paths.extend(PATH_CELL.pack(p.y, p.x) for p in e.pth)
+            path_len = len(e.pth)
+
+        index[e] = len(records)
+        records.append(_entity_record(e, path_start, path_len))
+
+    for e in world.entities:
+        for b in world.buffs.get_buffs(e):
+            buffs.append(BUFF.pack(index[e], buff_codes[type(b)], b.get_duration(), _saved_buff_value(b)))
+
+    visible = world.visible.data #BitGrid already uses the snapshot's bit layout
+    explored = world.explored.data
+
+    terrain_at = HEADER.size
+    entities_at = terrain_at + len(terrain)
+    paths_at = entities_at + ENTITY.size * len(records)
+    buffs_at = paths_at + PATH_CELL.size * len(paths)
+    visible_at = buffs_at + BUFF.size * len(buffs)
+    explored_at = visible_at + len(visible)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, height, width, world.visibility_dis,
+            len(records) if wall_slot is None else wall_slot,
+            len(records), len(paths), len(buffs),
+            terrain_at, entities_at, paths_at, buffs_at, visible_at, explored_at))
+        f.write(terrain)
+        f.write(b''.join(records))
+        f.write(b''.join(paths))
+        f.write(b''.join(buffs))
+        f.write(visible)
+        f.write(explored)
+
+
+class Snapshot(object):
+    '''
+    A memory mapped snapshot. Nothing is decoded up front: terrain is a view straight into the file, so
+    reading one cell or finding every wall of a large map never walks the grid in Python.
+    '''
+
+    def __init__(self, path):
+        self.terrain = self.visible_bits = self.explored_bits = self.view = self.map = None
+        self.file = open(path, 'rb')
+        try:
+            self._map()
+        except BaseException:
+            self.close()
+            raise
+
+    def _map(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size: #mmap refuses empty files, and there would be no header to read anyway
+            raise SnapshotError('Truncated snapshot header')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fields = HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            raise SnapshotError('Truncated snapshot header')
+        (magic, version, self.height, self.width, self.visibility_dis, self.wall_slot,
+            self.entity_count, self.path_count, self.buff_count,
+            self.terrain_at, self.entities_at, self.paths_at, self.buffs_at, self.visible_at, self.explored_at) = fields
+
+        if magic != MAGIC:
+            raise SnapshotError('Not a world snapshot')
+        if version != VERSION:
+            raise SnapshotError('Unsupported snapshot version %d' % version)
+
+        #every section must lie inside the file, so the readers below never run short
+        cells = self.height * self.width
+        bits = (cells + 7) // 8
+        for at, length in ((self.terrain_at, cells), (self.entities_at, ENTITY.size * self.entity_count),
+                (self.paths_at, PATH_CELL.size * self.path_count), (self.buffs_at, BUFF.size * self.buff_count),
+                (self.visible_at, bits), (self.explored_at, bits)):
+            if at < HEADER.size or at + length > size:
+                raise SnapshotError('Truncated snapshot')
+
+        self.view = memoryview(self.map)
+        self.terrain = self.view[self.terrain_at:self.terrain_at + cells]
+        self.visible_bits = self.view[self.visible_at:self.visible_at + bits]
+        self.explored_bits = self.view[self.explored_at:self.explored_at + bits]
+
+    def close(self):
+        for v in (self.terrain, self.visible_bits, self.explored_bits, self.view):
+            if v is not None:
+                v.release()
+        self.terrain = self.visible_bits = self.explored_bits = self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def cell(self, y, x):
+        return self.terrain[y * self.width + x]
+
+    def walls(self):
+        '''Yields (y, x, code) for every non empty terrain cell.'''
+        width = self.width
+        for m in _nonzero.finditer(self.map, self.terrain_at, self.terrain_at + self.height * width):
+            i = m.start() - self.terrain_at
+            yield i // width, i % width, self.map[m.start()]
+
+    def entity_records(self):
+        return ENTITY.iter_unpack(self.map[self.entities_at:self.entities_at + ENTITY.size * self.entity_count])
+
+    def path(self, start, length):
+        if start + length > self.path_count:
+            raise SnapshotError('Path out of range')
+        at = self.paths_at + start * PATH_CELL.size
+        return [Pair(y, x) for y, x in PATH_CELL.iter_unpack(self.map[at:at + length * PATH_CELL.size])]
+
+    def buff_records(self):
+        return BUFF.iter_unpack(self.map[self.buffs_at:self.buffs_at + BUFF.size * self.buff_count])
+
+    def visible(self):
+        return BitGrid(self.height, self.width, self.visible_bits)
+
+    def explored(self):
+        return BitGrid(self.height, self.width, self.explored_bits)
+
+
+def _build_entity(snp, rec):
+    code, sub, last_dir, y, x, hp, rom_timer, base_rom, a, b, path_start, path_len = rec
+    typ = entity_types.get(code)
+    if typ is None:
+        raise SnapshotError('Unknown entity type %d' % code)
+    pos = Pair(y, x)
+
+    if typ is Player:
+        e = Player(pos)
+        e.hp, e.base_rof = hp, b
+        e.set_rof_timer(a)
+    elif typ in (Spooker, FastSpooker):
+        e = typ(pos, pth=deque(snp.path(path_start, path_len)))
+        e.hp = hp
+        mood = mood_types[sub](e)
+        if isinstance(mood, BoredMood):
+            mood.pthindex = b
+        e.moodController.mood = mood
+    elif typ is Fireball:
+        e = Fireball(pos, sub)
+        e.outside_vision_count, e.ded = a, bool(b)
+    else:
+        e = Potion(pos, buff_types[sub], a)
+        e.applied = bool(b)
+
+    if isinstance(e, MobileEntity):
+        e.set_base_rom(base_rom)
+        e.set_rom_timer(rom_timer)
+        e.last_direction = last_dir
+    return e
+
+
+def load_world(path, world=None):
+    '''Builds a World from a snapshot file, or fills the given empty World, which must have matching bounds.'''
+    with Snapshot(path) as snp:
+        if world is None:
+            world = World(snp.height, snp.width)
+        elif (world.height, world.width) != (snp.height, snp.width):
+            raise SnapshotError('Snapshot is %dx%d, world is %dx%d' % (snp.height, snp.width, world.height, world.width))
+        world.visibility_dis = snp.visibility_dis
+
+        ents = [_build_entity(snp, rec) for rec in snp.entity_records()]
+        walls = []
+        for y, x, code in snp.walls():
+            if code & BREAKABLE:
+                wa = BreakableWall(Pair(y, x))
+                wa.hp = code & ~BREAKABLE
+            else:
+                wa = Wall(Pair(y, x))
+            walls.append(wa)
+
+        for owner, code, duration, saved in snp.buff_records():
+            unit = ents[owner]
+            b = buff_types[code](unit, duration)
+            _restore_buff(b, saved)
+            world.buffs.add(unit, b)
+
+        for e in ents[:snp.wall_slot] + walls + ents[snp.wall_slot:]:
+            world.add(e)
+        world.visible = snp.visible()
+        world.explored = snp.explored()
+        world.reindex()
+    return world
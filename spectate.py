@@ -0,0 +1,261 @@
+'''
+Live spectating. A SpectatorServer listens on a TCP port or a Unix socket and streams every frame the
+DrawController renders to any number of spectators; `python spectate.py HOST:PORT` (or a socket path) watches.
+
+The game thread only hands each frame's changed cells to the server's event loop, which runs on its own thread,
+keeps the current picture and encodes every frame once for all spectators. A spectator that falls more than
+max_queued frames behind has its backlog dropped and gets a keyframe once it has caught up, so a slow spectator
+never holds up the game or the other spectators.
+
+Messages are MESSAGE (type, payload length) followed by the payload:
+    HELLO       SIZE (height, width)
+    PALETTE     per color: ENTRY (handle, code length), then its SGR escape code
+    FRAME       flags (KEYFRAME: clear the screen first), then per run of same colored cells in a row:
+                RUN (y, x, handle, text length), then the utf-8 text
+'''
+import asyncio
+import os
+import socket
+import struct
+import sys
+import threading
+
+from terminal_engine import AnsiScreen
+
+MESSAGE = struct.Struct('<BI')
+SIZE = struct.Struct('<HH')
+ENTRY = struct.Struct('<HB')
+RUN = struct.Struct('<HHHH')
+
+HELLO = 1
+PALETTE = 2
+FRAME = 3
+
+KEYFRAME = 1
+
+
+def _message(kind, payload):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+
+def _palette(colors, handles):
+    '''colors is the game's ColorController, the one that interned the handles.'''
+    buf = bytearray()
+    for h in handles:
+        code = colors.sgr(h)
+        buf += ENTRY.pack(h, len(code))
+        buf += code
+    return _message(PALETTE, bytes(buf))
+
+
+def _frame(cells, flags=0):
+    '''cells is a sorted list of ((y, x), (ch, handle)).'''
+    buf = bytearray([flags])
+    run = None
+    for (y, x), (ch, co) in cells:
+        if run is not None and run[0] == y and run[1] + len(run[3]) == x and run[2] == co:
+            run[3].append(ch)
+            continue
+        if run is not None:
+            text = ''.join(run[3]).encode('utf-8')
+            buf += RUN.pack(run[0], run[1], run[2], len(text))
+            buf += text
+        run = [y, x, co, [ch]]
+    if run is not None:
+        text = ''.join(run[3]).encode('utf-8')
+        buf += RUN.pack(run[0], run[1], run[2], len(text))
+        buf += text
+    return _message(FRAME, bytes(buf))
+
+
+class _Spectator(object):
+    def __init__(self, writer, max_queued):
+        self.writer = writer
+        self.max_queued = max_queued
+        self.queue = []
+        self.needs_keyframe = True
+        self.wake = asyncio.Event()
+
+    def push(self, message):
+        if self.needs_keyframe:
+            return
+        if len(self.queue) >= self.max_queued:
+            self.queue = []
+            self.needs_keyframe = True
+        else:
+            self.queue.append(message)
+        self.wake.set()
+
+
+class SpectatorServer(object):
+    '''Give either port (TCP on host) or path (Unix socket). Port 0 picks a free port, see address after start().'''
+
+    def __init__(self, dc, host='127.0.0.1', port=None, path=None, max_queued=32):
+        self.dc = dc
+        self.colors = dc.colors
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_queued = max_queued
+
+        self.cells = {} #(y, x) -> (ch, handle), the picture as of the last frame
+        self.handles = set()
+        self.spectators = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.address = None
+        self.error = None #why the server could not start, raised again from start()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            self.thread.join()
+            raise self.error
+        self.dc.add_listener(self.on_frame)
+        return self
+
+    def stop(self):
+        self.dc.remove_listener(self.on_frame)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1)
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.path is not None:
+                listen = asyncio.start_unix_server(self._serve, path=self.path)
+            else:
+                listen = asyncio.start_server(self._serve, self.host, self.port)
+            self.server = self.loop.run_until_complete(listen)
+            self.address = self.server.sockets[0].getsockname()
+        except Exception as e: #e.g. the port is taken, start() raises it on the game thread
+            self.error = e
+            self.loop.close()
+            return
+        finally:
+            ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            for sp in list(self.spectators):
+                sp.writer.close()
+            self.loop.close()
+            if self.path is not None and os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def on_frame(self, cells):
+        '''DrawController listener, runs on the game thread and only passes the frame on.'''
+        if cells:
+            self.loop.call_soon_threadsafe(self._publish, cells)
+
+    def _publish(self, cells):
+        new = set()
+        changed = {}
+        for y, x, ch, co in cells:
+            changed[(y, x)] = (ch, co)
+            if co not in self.handles:
+                new.add(co)
+        self.cells.update(changed)
+        self.handles |= new
+
+        message = _frame(sorted(changed.items()))
+        if new:
+            message = _palette(self.colors, sorted(new)) + message
+        for sp in self.spectators:
+            sp.push(message)
+
+    def _keyframe(self):
+        return _palette(self.colors, sorted(self.handles)) + _frame(sorted(self.cells.items()), KEYFRAME)
+
+    async def _serve(self, reader, writer):
+        sp = _Spectator(writer, self.max_queued)
+        self.spectators.add(sp)
+        try:
+            writer.write(_message(HELLO, SIZE.pack(self.dc.height, self.dc.width)))
+            sp.wake.set()
+            while True:
+                await sp.wake.wait()
+                sp.wake.clear()
+                if sp.needs_keyframe:
+                    sp.needs_keyframe = False
+                    sp.queue = []
+                    writer.write(self._keyframe())
+                else:
+                    queued, sp.queue = sp.queue, []
+                    writer.write(b''.join(queued))
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.spectators.discard(sp)
+            writer.close()
+
+
+def _read_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            raise EOFError()
+        buf += data
+    return bytes(buf)
+
+
+def watch(sock, screen):
+    '''Replays the stream from a connected socket onto an AnsiScreen until the game goes away.'''
+    while True:
+        try:
+            kind, length = MESSAGE.unpack(_read_exactly(sock, MESSAGE.size))
+            payload = _read_exactly(sock, length)
+        except EOFError:
+            return
+        if kind == PALETTE:
+            at = 0
+            while at < len(payload):
+                h, n = ENTRY.unpack_from(payload, at)
+                at += ENTRY.size
+                screen.codes[h] = payload[at:at + n]
+                at += n
+        elif kind == FRAME:
+            if payload[0] & KEYFRAME:
+                screen.clear()
+            at = 1
+            while at < len(payload):
+                y, x, co, n = RUN.unpack_from(payload, at)
+                at += RUN.size
+                for i, ch in enumerate(payload[at:at + n].decode('utf-8')):
+                    screen.put(y, x + i, ch, co)
+                at += n
+            screen.flush()
+
+
+def connect(address):
+    '''address is HOST:PORT, or the path of a Unix socket.'''
+    if ':' in address and not os.path.exists(address):
+        host, port = address.rsplit(':', 1)
+        return socket.create_connection((host, int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python spectate.py HOST:PORT|SOCKET_PATH')
+        sys.exit(2)
+    sock = connect(sys.argv[1])
+    screen = AnsiScreen().start()
+    try:
+        watch(sock, screen)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        screen.close()
+        sock.close()
@@ -1,12 +1,21 @@
+from time import sleep, time
+_import_started = time()
+
 import curses, random
 from collections import defaultdict
-from time import sleep
 import dungeon
-import inspect
 from util import *
 import os
-from threading import Thread
 import sys
+import termios
+import tty
+import queue
+import threading
+from audio import AudioDispatcher
+from keyinput import InputReader
+from lighting import LightMap
+from animation import Animator, Track
+from roomgraph import RoomGraph
 
 TIME_UNIT = .017
 
@@ -23,62 +32,302 @@ color_map = {
 }
 
 
+def _xterm_index(r, g, b):
+    '''Nearest entry of the xterm 256 color palette (6x6x6 cube plus grey ramp).'''
+    level = lambda v: 0 if v < 48 else 1 if v < 115 else (v - 35) // 40
+    cube = 16 + 36 * level(r) + 6 * level(g) + level(b)
+    grey = sum((r, g, b)) // 3
+    if abs(r - grey) < 10 and abs(g - grey) < 10 and abs(b - grey) < 10 and 8 <= grey <= 238:
+        return 232 + (grey - 8) // 10
+    return cube
+
+def _xterm_rgb(i):
+    if i < 16:
+        return _basic_rgb[i % 8][1]
+    if i >= 232:
+        v = 8 + (i - 232) * 10
+        return (v, v, v)
+    i -= 16
+    return tuple(0 if c == 0 else 55 + 40 * c for c in (i // 36, i // 6 % 6, i % 6))
+
+_basic_rgb = [
+(curses.COLOR_BLACK, (0, 0, 0)),
+(curses.COLOR_RED, (205, 0, 0)),
+(curses.COLOR_GREEN, (0, 205, 0)),
+(curses.COLOR_YELLOW, (205, 205, 0)),
+(curses.COLOR_BLUE, (0, 0, 238)),
+(curses.COLOR_MAGENTA, (205, 0, 205)),
+(curses.COLOR_CYAN, (0, 205, 205)),
+(curses.COLOR_WHITE, (229, 229, 229)),
+]
+
+def _sgr_color(color, base):
+    '''SGR parameters for a color spec, base is 30 for text and 40 for the background.'''
+    if color in color_map:
+        color = color_map[color]
+    if isinstance(color, int):
+        if color < 0:
+            return b'%d' % (base + 9)
+        if color < 8:
+            return b'%d' % (base + color)
+        if color < 16:
+            return b'%d' % (base + 60 + color - 8)
+        return b'%d;5;%d' % (base + 8, color)
+    return b'%d;2;%d;%d;%d' % (base + 8, int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16))
+
 class ColorController():
-    def __init__(self):
-        if hasattr(ColorController, "_instance"):
-            raise Exception('This is a singleton.')
-        self.pairs = {}
-        self.counter = 1
-    @staticmethod
+    '''
+    Colors are asked for by (text, bg) through the static get_color, which interns the combination and returns a
+    small integer handle without touching curses, so entities can keep their handles as class constants.
+    A color is a name from color_map, a palette index (0-255) or an '#rrggbb' string.
+
+    Each DrawController owns an instance, mapping handles to curses pairs through plain lists. Pairs are created on first use; once the
+    terminal runs out, the least recently drawn handle with no cell left on the screen gives up its pair (recoloring
+    a pair recolors every cell showing it). Handles interned before start() (every class constant) are allocated up
+    front and never evicted. A handle that finds no pair is drawn with the default pair.
+    '''
+    _handles = {}
+    _combos = [None] #handle 0 is the terminal's default pair
 
-    def get_instance():
-        if not hasattr(ColorController, '_instance'):
-            ColorController._instance = ColorController()
-        return ColorController._instance
+    def __init__(self):
+        self.headless = False
+        self.max_pairs = 255
+        self.colors = 256
+        self.can_change = False
+        self.custom_colors = {}
+        self.next_custom = 0
+        self.in_use = set() #see _palette_in_use
+        self.in_use_upto = 1 #combos scanned into in_use so far, the first is None
+
+        self.pair_of = [0]
+        self.attrs = [0]
+        self.last_used = [0]
+        self.pinned = [True]
+        self.on_screen = [0] #handle -> screen cells showing it, kept by the DrawController
+        self.handle_of_pair = [0]
+        self.frame = 0
+        self.exhausted = False #every pair is pinned, nothing is ever allocated again
+        self.failed_frame = -1 #frame in which no pair could be freed, not looked for again until the next one
 
     @staticmethod
     def get_color(text, bg):
-        self = ColorController.get_instance()
-        if (text, bg) in self.pairs:
-            return self.pairs[(text, bg)]
-
+        handles = ColorController._handles
+        h = handles.get((text, bg))
+        if h is None:
+            h = handles[(text, bg)] = len(ColorController._combos)
+            ColorController._combos.append((text, bg))
+        return h
+
+    def start(self):
+        '''Call once curses colors are up. Reads the terminal's limits and allocates every handle known so far.'''
+        if not self.headless:
+            self.max_pairs = min(curses.COLOR_PAIRS, 256) - 1 #color_pair() only encodes pairs below 256
+            self.colors = curses.COLORS
+            self.can_change = curses.can_change_color()
+            self.next_custom = self.colors - 1
+        self.handle_of_pair = [0] * (self.max_pairs + 1)
+        for h in range(1, min(len(ColorController._combos), self.max_pairs + 1)):
+            self._allocate(h)
+            self.pinned[h] = True
+        self.exhausted = len(ColorController._combos) - 1 >= self.max_pairs
+
+    def next_frame(self):
+        self.frame += 1
+
+    def _grow(self):
+        n = len(ColorController._combos) - len(self.pair_of)
+        self.pair_of.extend([0] * n)
+        self.attrs.extend([0] * n)
+        self.last_used.extend([0] * n)
+        self.pinned.extend([False] * n)
+        self.on_screen.extend([0] * n)
+
+    def swap_shown(self, old, new):
+        '''A screen cell showing handle old (None if it showed nothing) now shows new.'''
+        if new >= len(self.on_screen):
+            self._grow()
+        if old is not None:
+            self.on_screen[old] -= 1
+        self.on_screen[new] += 1
+
+    def forget_shown(self):
+        '''The screen is about to be redrawn from scratch.'''
+        self.on_screen = [0] * len(self.on_screen)
+
+    def resolve(self, color):
+        '''Turns a color spec into a curses color number the terminal can show.'''
+        if color in color_map:
+            return color_map[color]
+        if isinstance(color, int):
+            if color < self.colors:
+                return color
+            rgb = _xterm_rgb(color)
         else:
-            self.pairs[(text, bg)] = self.counter
-            curses.init_pair(self.counter, color_map[text], color_map[bg])
-            self.counter += 1
-            return self.counter - 1
+            rgb = (int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16))
+            if rgb in self.custom_colors:
+                return self.custom_colors[rgb]
+            if self.can_change:
+                in_use = self._palette_in_use()
+                while self.next_custom >= 16 and self.next_custom in in_use:
+                    self.next_custom -= 1
+            if self.can_change and self.next_custom >= 16:
+                c = self.next_custom
+                self.next_custom -= 1
+                if not self.headless:
+                    curses.init_color(c, *[v * 1000 // 255 for v in rgb])
+                self.custom_colors[rgb] = c
+                return c
+            if self.colors >= 256:
+                return _xterm_index(*rgb)
+        return min(_basic_rgb, key=lambda e:sum((a - b)**2 for a, b in zip(e[1], rgb)))[0]
+
+    def _palette_in_use(self):
+        '''Palette indices some interned color names directly, init_color must leave those alone.'''
+        combos = ColorController._combos
+        if self.in_use_upto != len(combos):
+            for combo in combos[self.in_use_upto:]:
+                for color in combo or ():
+                    if isinstance(color, int) and color >= 0:
+                        self.in_use.add(color)
+            self.in_use_upto = len(combos)
+        return self.in_use
+
+    def _allocate(self, handle):
+        self._grow()
+        pair = self.handle_of_pair.index(0, 1) if 0 in self.handle_of_pair[1:] else None
+        if pair is None:
+            victim = None
+            for h in range(1, len(self.pair_of)):
+                if self.pair_of[h] and not self.pinned[h] and not self.on_screen[h] and \
+                        (victim is None or self.last_used[h] < self.last_used[victim]):
+                    victim = h
+            if victim is None:
+                self.failed_frame = self.frame
+                return 0
+            pair = self.pair_of[victim]
+            self.pair_of[victim] = 0
+            self.attrs[victim] = 0
+
+        text, bg = ColorController._combos[handle]
+        if not self.headless:
+            curses.init_pair(pair, self.resolve(text), self.resolve(bg))
+        self.handle_of_pair[pair] = handle
+        self.pair_of[handle] = pair
+        self.attrs[handle] = pair << 8 if self.headless else curses.color_pair(pair)
+        return pair
+
+    @staticmethod
+    def sgr(handle):
+        '''ANSI select graphic rendition sequence for a handle, for backends that bypass curses.'''
+        if not handle:
+            return b'\x1b[0m'
+        text, bg = ColorController._combos[handle]
+        return b'\x1b[0;%s;%sm' % (_sgr_color(text, 30), _sgr_color(bg, 40))
+
+    def attr(self, handle):
+        '''Curses attribute for a handle, allocating or recycling a pair if it has none.'''
+        if handle >= len(self.attrs):
+            self._grow()
+        a = self.attrs[handle]
+        if not a and handle and not self.exhausted and self.failed_frame != self.frame:
+            self._allocate(handle)
+            a = self.attrs[handle]
+        self.last_used[handle] = self.frame
+        return a
 
 #--------------------- 
 #Container classes
         
+#Layers of the frame, bottom to top. Under all of them the rules paint the background.
+TERRAIN = 1
+ITEMS = 2
+ACTORS = 3
+EFFECTS = 4
+HUD = 5
+
+class Layer():
+    '''The cells one layer holds, (y, x) -> (ch, color handle), and which of them changed since the last render.'''
+    def __init__(self):
+        self.cells = {}
+        self.dirty = set()
+
+    def put(self, p, ch, co):
+        if self.cells.get(p) != (ch, co):
+            self.cells[p] = (ch, co)
+            self.dirty.add(p)
+
+    def erase(self, p):
+        if self.cells.pop(p, None) is not None:
+            self.dirty.add(p)
+
 class DrawController():
+    '''
+    Composites a stack of layers onto the screen. The rules paint a background layer that is only evaluated
+    again for invalidated cells; TERRAIN to HUD hold whatever was drawn on them. A render looks at the cells
+    that changed on some layer, takes each from the topmost layer that has it and puts it on the screen if it
+    differs from what is there, so an actor moving over terrain is repainted from the layers underneath.
+    '''
     def __init__(self):
-        self.draw_buffer = defaultdict(list)
         self.default_char = ' '
 
         self.rules = {}
-        self.rule_assignments = defaultdict(list)
+        self.painted_by = {} #(y, x) -> id of the rule the background there comes from
+
+        self.base = Layer() #what the rules paint
+        self.layers = [self.base] + [Layer() for l in range(TERRAIN, HUD + 1)] #indexed by layer
+        self.shown = {} #(y, x) -> (ch, color) as last put on the screen
+        self.transient = set() #(layer, cell) drawn transient this frame
+        self.last_transient = set()
+        self.dirty = defaultdict(list) #row -> unmerged (x0, x1) spans whose rules have to be evaluated again
+
+        self.listeners = []
+        self.frame = None #(y, x, ch, color) put this frame, only collected while somebody listens
+
+        self.colors = ColorController()
+
+    def init_screen(self, screen=None):
+        '''
+        Sets up curses behind a CursesScreen, or uses the given backend (a NullScreen, an AnsiScreen) without
+        curses. A backend needs getmaxyx(), put(y, x, ch, color handle), flush() and close().
+        '''
+        if screen is None:
+            stdscr = curses.initscr()
+            curses.noecho()
+            curses.cbreak()
+            curses.curs_set(0)
+            stdscr.nodelay(1)
+            stdscr.keypad(1)
+
+            curses.start_color()
+            curses.use_default_colors()
+            screen = CursesScreen(stdscr, self.colors)
+        else:
+            self.colors.headless = True
 
-        self.drawn = set()
-        self.to_restore = set()
+        self.screen = screen
+        self.height, self.width = screen.getmaxyx()
+        self.default_color = ColorController.get_color('black', 'black')
+        self.colors.start()
 
-    def init_screen(self):
-        stdscr = curses.initscr()
-        curses.noecho()
-        curses.cbreak()
-        curses.curs_set(0)
-        stdscr.nodelay(1)
-        stdscr.keypad(1)
 
-        curses.start_color()
-        curses.use_default_colors()
+        return screen
 
-        self.screen = stdscr
-        self.height, self.width = stdscr.getmaxyx()
-        self.default_color = ColorController.get_color('black', 'black')
+    def close(self):
+        self.screen.close()
 
+    def add_listener(self, listener):
+        '''
+        listener(cells) is called after every render with the (y, x, ch, color handle) cells it changed, on the
+        game thread, so it must return quickly. The next render redraws everything to give it a full picture.
+        '''
+        self.listeners.append(listener)
+        self.frame = []
+        self.full_draw()
 
-        return stdscr
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+        if not self.listeners:
+            self.frame = None
 
     def set_default_char(self, c):
         self.default_char = c
@@ -87,20 +336,69 @@ class DrawController():
         self.default_color = co
 
     def update(self, modified):
-        self.to_restore.update(modified)
+        '''Evaluate the rules again for some cells, given as (y, x) pairs.'''
+        self.invalidate_cells(modified)
+
+    def invalidate_span(self, y, x0, x1):
+        '''Restore cells x0 <= x < x1 of row y.'''
+        self.dirty[y].append((x0, x1))
+
+    def invalidate_rect(self, y, x, height, width):
+        for row in range(max(y, 0), min(y + height, self.height)):
+            self.dirty[row].append((x, x + width))
+
+    def invalidate_cells(self, cells):
+        '''Turns loose cells into row spans, runs of neighbouring cells become a single span.'''
+        start = None
+        for y, x in sorted((y, x) for y, x in cells):
+            if start is not None and y == row and x <= end:
+                end = max(end, x + 1)
+                continue
+            if start is not None:
+                self.dirty[row].append((start, end))
+            row, start, end = y, x, x + 1
+        if start is not None:
+            self.dirty[row].append((start, end))
+
+    def dirty_spans(self):
+        '''Yields (y, x0, x1) for every invalidated span, merged and clipped to the screen, row by row.'''
+        for y in sorted(self.dirty):
+            if y < 0 or y >= self.height:
+                continue
+            merged = []
+            for x0, x1 in sorted(self.dirty[y]):
+                x0, x1 = max(x0, 0), min(x1, self.width)
+                if x0 >= x1:
+                    continue
+                if merged and x0 <= merged[-1][1]:
+                    if x1 > merged[-1][1]:
+                        merged[-1][1] = x1
+                else:
+                    merged.append([x0, x1])
+            for x0, x1 in merged:
+                yield y, x0, x1
 
     def add_rule(self, rule_id, rule, ch, color=1, modified=None):
-        ''' Adds a rule, if modified is not none it will only update those cells. rule_id must be unique '''
+        '''
+        Adds a rule, if modified is not none it will only update those cells. rule_id must be unique.
+        color is a handle, or a callable giving the handle for a cell.
+        '''
         assert rule_id not in self.rules
         self.rules[rule_id] = (rule,ch,color)
         if modified is None:
+            p = Pair(0, 0)
             for i in range(self.height):
-                for j in range(self.width):
-                    p = Pair(i,j)
-                    if rule(p):
-                        self.to_restore.add(p)
+                start = None
+                for j in range(self.width + 1):
+                    p.y, p.x = i, j
+                    hit = j < self.width and rule(p)
+                    if hit and start is None:
+                        start = j
+                    elif not hit and start is not None:
+                        self.invalidate_span(i, start, j)
+                        start = None
         else:
-            self.to_restore.update(modified)
+            self.invalidate_cells(modified)
 
     def update_rule(self, rule_id, rule, ch, color=1, modified=None):
         self.remove_rule(rule_id)
@@ -109,59 +407,210 @@ class DrawController():
     def remove_rule(self, rule_id):
         if rule_id in self.rules:
             self.rules.pop(rule_id)
-            self.to_restore.update(self.rule_assignments[rule_id])
-            self.rule_assignments.pop(rule_id)
+            self.invalidate_cells([p for p, k in self.painted_by.items() if k == rule_id])
 
     def _draw_char(self, y, x, ch, co):
 
         if y < self.height and y >= 0 and x < self.width and x >= 0 and (y < self.height - 1 or x < self.width - 1):
-            draw_y, draw_x = Pair(y,x).rounded()
-            self.screen.addstr(draw_y, draw_x, ch, curses.color_pair(co))
+            y, x = int(y+.5), int(x+.5)
+            self.screen.put(y, x, ch, co)
+            if self.frame is not None:
+                self.frame.append((y, x, ch, co))
 
     def full_draw(self):
         ''' prepares to redraw every cell, the subsequent render (restore) will be expensive '''
-        for i in range(self.height):
-            for j in range(self.width):
-                p = Pair(i,j)
-                self.to_restore.add(p)
+        self.base.cells = {}
+        self.shown = {}
+        self.colors.forget_shown()
+        for layer in self.layers:
+            layer.dirty.update(layer.cells)
+        self.invalidate_rect(0, 0, self.height, self.width)
 
     def restore(self):
-        '''Each iteration, anything not explicitly drawn that was previously drawn is redrawn to the value specified in the rules, or the default'''
-        self.rule_assignments = defaultdict(list)
-        for pix in self.to_restore:
-            for k in self.rules:
-                rule = self.rules[k]
-                if rule[0](pix):
-                    self._draw_char(pix.y, pix.x, rule[1], rule[2])
-                    self.rule_assignments[k].append(pix)
+        '''Paints the background layer from the rules, or the default, for every invalidated cell.'''
+        painted_by = self.painted_by
+        rules = list(self.rules.items())
+        base = self.base
+        p = Pair(0, 0) #handed to every rule, rules must not keep it
+        for y, x0, x1 in self.dirty_spans():
+            for x in range(x0, x1):
+                p.y, p.x = y, x
+                for k, rule in rules:
+                    if rule[0](p):
+                        co = rule[2]
+                        base.put((y, x), rule[1], co(p) if callable(co) else co)
+                        painted_by[(y, x)] = k
+                        break
+                else:
+                    base.put((y, x), self.default_char, self.default_color)
+                    painted_by.pop((y, x), None)
+
+        self.dirty = defaultdict(list)
+
+    def draw(self, buffered_chars, persistent=False, layer=HUD):
+        '''
+        Puts chars on a layer. Transient chars are erased on the next render unless drawn again. Persistent chars
+        stay until erased or drawn over on the same layer.
+        '''
+        cells = self.layers[layer]
+        for bc in buffered_chars:
+            y, x = bc.pos
+            p = (int(y+.5), int(x+.5))
+            cells.put(p, bc.char, bc.color)
+            if not persistent:
+                self.transient.add((layer, p))
+
+    def erase(self, layer, cells):
+        '''Takes (y, x) cells off a layer, uncovering whatever lies underneath.'''
+        lay = self.layers[layer]
+        for y, x in cells:
+            lay.erase((y, x))
+
+    def clear(self, layer):
+        lay = self.layers[layer]
+        for p in list(lay.cells):
+            lay.erase(p)
+
+    def composite(self):
+        '''Puts every cell that changed on some layer on the screen, as the topmost layer holding it has it.'''
+        dirty = set()
+        for layer in self.layers:
+            dirty |= layer.dirty
+            layer.dirty = set()
+        top_down = self.layers[::-1]
+        shown = self.shown
+        colors = self.colors
+        for p in sorted(dirty):
+            for layer in top_down:
+                c = layer.cells.get(p)
+                if c is not None:
                     break
             else:
-                self._draw_char(pix.y, pix.x, self.default_char, self.default_color)
-
-        self.to_restore = set()
+                c = (self.default_char, self.default_color)
+            old = shown.get(p)
+            if old != c:
+                shown[p] = c
+                if old is None or old[1] != c[1]:
+                    colors.swap_shown(None if old is None else old[1], c[1])
+                self._draw_char(p[0], p[1], c[0], c[1])
 
-    def draw(self, buffered_chars):
-        
-        for bc in buffered_chars:
+    def render(self):
+        for layer, p in self.last_transient - self.transient:
+            self.layers[layer].erase(p)
+        self.last_transient, self.transient = self.transient, set()
+        self.restore()
+        self.composite()
+        self.screen.flush()
+        self.colors.next_frame()
+        if self.listeners:
+            frame, self.frame = self.frame, []
+            for listener in self.listeners:
+                listener(frame)
+
+class CursesScreen():
+    '''The default backend, cells go through curses, which works out what changed when flushed.'''
+    def __init__(self, stdscr, colors):
+        self.stdscr = stdscr
+        self.colors = colors
+
+    def getmaxyx(self):
+        return self.stdscr.getmaxyx()
+
+    def put(self, y, x, ch, co):
+        self.stdscr.addstr(y, x, ch, self.colors.attr(co))
+
+    def flush(self):
+        self.stdscr.refresh()
+
+    def close(self):
+        curses.endwin()
 
-            y,x = bc.pos
+class AnsiScreen():
+    '''
+    Backend writing escape sequences straight to the terminal. DrawController only puts cells that changed, so
+    there is nothing left to diff: each frame is built into one bytearray, skipping cursor moves onto the cell
+    the cursor already sits on and color changes to the color already set, and goes out in a single os.write.
+    '''
+    def __init__(self, fd=None, input_fd=None):
+        self.fd = sys.stdout.fileno() if fd is None else fd
+        self.input_fd = sys.stdin.fileno() if input_fd is None else input_fd
+        self.width, self.height = os.get_terminal_size(self.fd)
+        self.out = bytearray()
+        self.cy = self.cx = -1 #where the terminal cursor is, -1 when unknown
+        self.color = None
+        self.codes = {}
+        self.saved_mode = None
+        self.started = False
+
+    def start(self):
+        '''Puts the terminal in cbreak mode on the alternate screen, with the cursor hidden.'''
+        if os.isatty(self.input_fd):
+            self.saved_mode = termios.tcgetattr(self.input_fd)
+            tty.setcbreak(self.input_fd)
+        self.started = True
+        self.out += b'\x1b[?1049h\x1b[?25l\x1b[0m\x1b[2J'
+        self.flush()
+        return self
 
-            color, char = bc.color, bc.char
-            self._draw_char(y, x, char, color)
-            
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def put(self, y, x, ch, co):
+        out = self.out
+        if y != self.cy:
+            out += b'\x1b[%d;%dH' % (y + 1, x + 1)
+        elif x != self.cx:
+            out += b'\x1b[%dC' % (x - self.cx) if x > self.cx else b'\x1b[%dG' % (x + 1)
+        if co != self.color:
+            code = self.codes.get(co)
+            if code is None:
+                code = self.codes[co] = ColorController.sgr(co)
+            out += code
+            self.color = co
+        out += ch.encode('utf-8')
+        self.cy, self.cx = y, x + 1
+        if self.cx >= self.width: #the terminal may or may not have wrapped
+            self.cy = -1
+
+    def clear(self):
+        self.out += b'\x1b[0m\x1b[2J'
+        self.color = None
+        self.cy = -1
+
+    def flush(self):
+        out, self.out = self.out, bytearray() #a write cut short by a signal leaves no export of self.out behind
+        with memoryview(out) as view:
+            at = 0
+            while at < len(out):
+                at += os.write(self.fd, view[at:])
+
+    def close(self):
+        '''Gives the terminal back as start() found it. Safe to call more than once.'''
+        if self.started:
+            self.started = False
+            self.out = bytearray(b'\x1b[0m\x1b[?25h\x1b[?1049l') #drop whatever an interrupted frame left
+            self.flush()
+        if self.saved_mode is not None:
+            termios.tcsetattr(self.input_fd, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+
+class NullScreen():
+    '''Stands in for the terminal when running without one.'''
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
 
-            p = bc.pos.rounded()
-            if p in self.to_restore:
-                self.to_restore.remove(p)
+    def getmaxyx(self):
+        return (self.height, self.width)
 
-            self.drawn.add(p)
+    def put(self, y, x, ch, co):
+        pass
 
+    def flush(self):
+        pass
 
-    def render(self):
-        self.restore()
-        self.to_restore = self.drawn
-        self.drawn = set()
-        self.screen.refresh()
+    def close(self):
+        pass
 
 class TextBox():
     def __init__(self, pos, height, width):
@@ -174,12 +623,25 @@ class TextBox():
 
 #--------------------
 
+LIGHT_SHADES = [ColorController.get_color(g, g) for g in (235, 237, 239, 242, 245, 248, 251, 'white')]
+REMEMBERED_FLOOR = ColorController.get_color(233, 233)
+REMEMBERED_WALL = ColorController.get_color(22, 22)
+
 class MainController():
-    def __init__(self, world_height=None, world_width=None):
+    def __init__(self, world_height=None, world_width=None, headless=False, input_source=None, screen=None):
+        '''
+        headless runs without a terminal: nothing is drawn and world_height/world_width are required.
+        input_source replaces the stdin reader, it needs get_events() and stop().
+        screen replaces curses as the draw backend, see DrawController.init_screen.
+        '''
         dc = DrawController()
-        scr = dc.init_screen()
+        if headless:
+            scr = dc.init_screen(NullScreen(world_height, world_width))
+        else:
+            scr = dc.init_screen(screen)
         self.dc = dc
         self.screen = scr
+        self.headless = headless
 
         if world_height is None:
             world_height = dc.height
@@ -187,20 +649,74 @@ class MainController():
         if world_width is None:
             world_width = dc.width
 
-        w = World(world_height, world_width)
+        ctx = SharedContext()
+        ctx.draw_controller = dc
+        self.ctx = ctx
+
+        w = World(world_height, world_width, ctx=ctx)
         self.w = w
 
-        self.dc.add_rule('vis', lambda p:p in self.w.visible, ' ', color = ColorController.get_color("white","white"))
+        self.lights = LightMap(w, LIGHT_SHADES)
+        self.dc.add_rule('vis', lambda p:p in self.w.visible, ' ', color = lambda p:self.lights.color_at(p))
         self.dc.add_rule('outside', lambda p:p.y>= world_height or p.x >= world_width, ' ', color = ColorController.get_color(-1,-1))
+        #explored cells out of sight, painted once when they leave the visible set and left alone after that
+        self.dc.add_rule('remembered_wall', lambda p:p in self.w.explored and self.w.is_wall(p), ' ', color = REMEMBERED_WALL)
+        self.dc.add_rule('remembered', lambda p:p in self.w.explored, ' ', color = REMEMBERED_FLOOR)
 
-        ctx = SharedContext()
-        ctx.world = self.w
-        ctx.draw_controller = dc
-        self.ctx = ctx
+        if input_source is None:
+            input_source = InputReader()
+            input_source.start()
+        self.input = input_source
+
+        self.recorder = None
+        self.tick_keys = []
+
+        self.levels = None
+        self.player = None
 
     def get_draw_controller(self):
         return self.dc
 
+    def get_player(self):
+        return self.player
+
+    def set_level_source(self, levels):
+        '''levels hands out ready Worlds through get(), or None while the next one is still being built.'''
+        self.levels = levels
+
+    def start_level(self, world):
+        '''Switches to world, carrying the player (and its buffs) over from the current level if there is one.'''
+        old = self.w
+        world.visibility_dis = old.visibility_dis
+        world.rng = old.rng
+        world.set_ai(old.ai)
+        if self.player is not None:
+            old.buffs.transfer(self.player, world.buffs)
+        self.w = world
+        world.set_context(self.ctx)
+        self.lights = LightMap(world, LIGHT_SHADES)
+
+        if self.player is None:
+            self.player = Player(Pair(30,90))
+        else:
+            self.player.set_pos(Pair(30,90))
+        world.add(self.player, first=True)
+        world.reindex()
+
+        if not self.headless:
+            for layer in (TERRAIN, ITEMS, ACTORS, EFFECTS): #the old level's entities
+                self.dc.clear(layer)
+            self.dc.full_draw()
+        return self.player
+
+    def draw_loading(self):
+        if self.headless:
+            return
+        st = 'Loading...'
+        pos = Pair(self.w.height//2, max(0, (self.w.width - len(st))//2))
+        self.dc.draw(BufferedChar.from_string(st, pos, 1, ColorController.get_color("black", "white")))
+        self.dc.render()
+
     def draw_player_stats(self):
         pl = self.ctx.get_player_pos()[0]
         buffs = sorted(map(str, pl.get_buffs()))
@@ -217,59 +733,66 @@ class MainController():
             self.dc.draw(BufferedChar.from_string(str(b), Pair(i+2,self.w.width+1), 1, ColorController.get_color("black", "white")))
 
     def tock(self):
+        if self.levels is not None and not self.w.get_all_of_type(Spooker):
+            level = self.levels.get()
+            if level is None: #keys stay queued until the level is ready
+                self.draw_loading()
+                return
+            self.start_level(level)
+
         self.handle_input()
         
         self.w.update()
 
         old_vis = self.w.visible
         self.w.calc_visibility()
-        chrs = self.w.get_draws()
-
-        self.dc.update(old_vis^self.w.visible) #explicitly update only the cells that changed visibility.
 
-        for c in chrs:
-            self.dc.draw(c)
+        if self.recorder is not None:
+            self.recorder.record(self.tick_keys, self.w)
 
-        self.draw_player_stats()
+        if self.headless:
+            return
 
-        self.dc.render()
+        vis_changed = old_vis^self.w.visible
+        visible = self.w.visible
+        changed = list(vis_changed) + [p for p in self.lights.update() if p in visible]
+        self.dc.update(changed) #explicitly update only the cells that changed visibility or light.
 
-    def handle_input(self): #order not guaranteed
-        pressed = set()
-        char = self.screen.getch()
-        while True:
-            if char != -1:
-                pressed.add(char)
-            else:
-                break
-            char = self.screen.getch()
+        chrs, vacated = self.w.get_draws()
+        for layer, p in vacated:
+            self.dc.erase(layer, (p,))
 
-        for k in pressed:
-            
-            for h in self.ctx.key_handlers[k]:
-                h.callback(h.key)
+        for layer, c in chrs:
+            self.dc.draw(c, persistent=True, layer=layer)
 
-class SharedContext(): #singleton
+        self.draw_player_stats()
 
-    @staticmethod
-    def get_instance():
-        if not hasattr(SharedContext, '_instance'):
-            SharedContext._instance = SharedContext()
-        return SharedContext._instance
+        self.dc.render()
 
-    def __init__(self):
+    def handle_input(self):
+        '''Dispatches every key received since the last tock, in the order they were pressed.'''
+        handlers = self.ctx.key_handlers.get_table()
+        self.tick_keys = []
+        for ev in self.input.get_events():
+            self.tick_keys.append(ev.key)
+            for h in handlers.get(ev.key, ()):
+                h.callback(h.key)
 
-        if hasattr(SharedContext, '_instance'):
-            raise Exception('No.')
+class SharedContext():
+    '''
+    What a running game shares: key handlers, the log, the draw controller and the current world. Every World
+    has one (its own unless given one) and entities reach it through the world they were added to, so any
+    number of worlds can live side by side in one process.
+    '''
 
-        SharedContext._instance = self
+    def __init__(self, world=None):
         self.log_list = []
 
-        self.key_handlers = defaultdict(list)
+        self.key_handlers = HandlerRegistry()
 
         self.draw_controller = None
 
-        self.world = None
+        self.world = world
 
     def log(self, val):
         self.log_list.append('%s'%val)
@@ -278,13 +801,22 @@ class SharedContext(): #singleton
         self.log(handler)
         assert isinstance(handler, KeyHandler)
 
-        self.key_handlers[handler.key].append(handler)
+        self.key_handlers.add(handler)
+
+    def register_keys(self, handlers):
+        for h in handlers:
+            self.log(h)
+            assert isinstance(h, KeyHandler)
+        self.key_handlers.add_all(handlers)
 
     def deregister_key(self, handler):
         ''' Only looks at key and registree '''
         assert isinstance(handler, KeyHandler)
 
-        self.key_handlers[handler.key] = filter(lambda e: e.registree != handler.registree,self.key_handlers[handler.key])
+        self.key_handlers.remove(handler.key, handler.registree)
+
+    def deregister_all(self, registree):
+        self.key_handlers.remove_registree(registree)
 
     def get_snapshot(self):
         return self.world.snapshot()
@@ -311,44 +843,131 @@ class SharedContext(): #singleton
     def get_world(self):
         return self.world   
 
-def visibility(obs, start, valid, height, width, dis):
-    assert isinstance(start, Pair)
-    assert isinstance(obs, set)
-    i = 0
-    vis = set()
-    for i in range(0, width):
-        vis.update(get_line(start, Pair(0,i), obs, dis=dis))
-        vis.update(get_line(start, Pair(height-1, i), obs, dis=dis))
-
-    for i in range(0, height):
-        vis.update(get_line(start, Pair(i,0), obs, dis=dis))
-        vis.update(get_line(start, Pair(i, width-1), obs, dis=dis))
-
-    return vis
+VIEW_RADIUS = 24 #how far field of view rays are cast, well past the widest visibility_dis
 
 #-------------------
 
 class World():
 
-    def __init__(self, height, width):
+    def __init__(self, height, width, ctx=None, rng=random):
+        '''rng drives everything random during play, pass a random.Random to keep the world to itself.'''
         self.height = height
         self.width = width
 
+        self.ctx = None
+        self.set_context(SharedContext() if ctx is None else ctx)
+        self.rng = rng
+        self.powerup_durations = powerup_durations #buff type -> duration of the potions found here
+
         self.entities = []
-        self.visible = set()
+        self.visible = BitGrid(height, width)
+        self.explored = BitGrid(height, width) #every cell that has been visible, grows in calc_visibility
 
         self.visible_ent = set()
 
         self.cached_snapshot = None
 
         self.by_type = defaultdict(list)
+        self.spatial = SpatialHash() #live positions, kept current by Entity.set_pos
+        self.rooms = None #RoomGraph of the generated dungeon, for long paths
 
         self.visibility_dis = 8
 
-    def add(self, e):
+        self.ai = None
+
+        self.draw_cache = {} #entity -> (render version, cells, chars, layer) as last drawn
+        self.drawn_at = defaultdict(set) #(layer, cell) -> entities drawn there
+
+        self.scheduler = Scheduler()
+        self.buffs = BuffManager(self.scheduler)
+        self.animations = Animator(self)
+
+        self.rays = RayTable.get_instance(VIEW_RADIUS, height, width)
+        self.static_opaque = None #occupancy grid of the dormant entities, rebuilt when they change
+        self.opaque = None
+
+        #Entities whose is_dormant() holds are not updated until something wakes them. They are indexed once into
+        #tuples that every tick's snapshot shares, so they cost nothing per tick.
+        self.order = {} #entity -> rank in update order
+        self.first_rank = -1
+        self.next_rank = 0
+        self.awake = []
+        self.dormant = set()
+        self.dormant_at = {}
+        self.dormant_by_type = {}
+        self.dormant_obs = set()
+        self.waking = set()
+
+    def set_context(self, ctx):
+        self.ctx = ctx
+        ctx.world = self
+
+    def set_ai(self, ai):
+        '''Attaches a planner (see parallel_ai.AIPool) that works out monster moves before they update.'''
+        self.ai = ai
+
+    def add(self, e, first=False):
         assert isinstance(e, Entity)
 
-        self.entities.append(e)
+        e.bind(self)
+        self.spatial.insert(e)
+        if first:
+            self.order[e] = self.first_rank
+            self.first_rank -= 1
+            self.entities.insert(0, e)
+            self.awake.insert(0, e)
+        else:
+            self.order[e] = self.next_rank
+            self.next_rank += 1
+            self.entities.append(e)
+            self.awake.append(e)
+
+    def wake(self, e):
+        '''Has a dormant entity update again, starting with the next tick.'''
+        if e in self.dormant:
+            self.waking.add(e)
+
+    def _index_dormant(self, ents):
+        cells = defaultdict(list)
+        types = defaultdict(list)
+        for e in ents:
+            cells[e.get_pos()].append(e)
+            for t in type(e).__mro__:
+                types[t].append(e)
+            if not e.is_transparent():
+                self.dormant_obs.add(e.get_pos())
+        for p, group in cells.items():
+            self.dormant_at[p] = self.dormant_at.get(p, ()) + tuple(group)
+        for t, group in types.items():
+            self.dormant_by_type[t] = self.dormant_by_type.get(t, ()) + tuple(group)
+        self.dormant.update(ents)
+        self.static_opaque = None
+
+    def _unindex_dormant(self, ents):
+        self.dormant -= ents
+        self.static_opaque = None
+        for p in set(e.get_pos() for e in ents):
+            rest = tuple(d for d in self.dormant_at[p] if d not in ents)
+            if rest:
+                self.dormant_at[p] = rest
+            else:
+                self.dormant_at.pop(p)
+            if all(d.is_transparent() for d in rest):
+                self.dormant_obs.discard(p)
+        for t in set(t for e in ents for t in type(e).__mro__):
+            rest = tuple(d for d in self.dormant_by_type[t] if d not in ents)
+            if rest:
+                self.dormant_by_type[t] = rest
+            else:
+                self.dormant_by_type.pop(t)
+
+    def wake_pending(self):
+        if not self.waking:
+            return
+        woken, self.waking = self.waking, set()
+        self._unindex_dormant(woken)
+        self.awake.extend(woken)
+        self.awake.sort(key=self.order.__getitem__)
 
     def snapshot(self):
         if self.cached_snapshot is not None:
@@ -367,52 +986,204 @@ class World():
     def get_all_of_type(self, typ):
         return self.by_type[typ]
 
-    def calc_visibility(self):
-        obs = set()
+    def within_radius(self, pos, r, typ=None):
+        '''Entities of type typ (any Entity by default) at most r cells from pos, as of right now.'''
+        return self.spatial.within_radius(pos, r, Entity if typ is None else typ)
+
+    def nearest(self, pos, typ=None):
+        '''One of the entities of type typ closest to pos right now, None if there is none.'''
+        return self.spatial.nearest(pos, Entity if typ is None else typ)
+
+    def reindex(self):
+        '''Rebuilds the position and type indexes after entities were added or changed outside of update.'''
+        self.order = dict((e, i) for i, e in enumerate(self.entities))
+        self.first_rank = -1
+        self.next_rank = len(self.entities)
+        self.awake = list(self.entities)
+        self.dormant = set()
+        self.dormant_at = {}
+        self.dormant_by_type = {}
+        self.dormant_obs = set()
+        self.waking = set()
+        self.static_opaque = None
+
+        snp = defaultdict(list)
+        by_type = defaultdict(list)
+        self.spatial.clear()
         for e in self.entities:
-            if not e.is_transparent():
-                obs.add(e.get_pos())
+            snp[e.get_pos()].append(e)
+            for t in type(e).__mro__:
+                by_type[t].append(e)
+            self.spatial.insert(e)
+        self.by_type = by_type
+        self.cached_snapshot = snp
 
-        valid = lambda n:n.y>=0 and n.y < self.height and n.x>=0 and n.x<self.width
-        visible = set()
-        for pl in filter(lambda x:isinstance(x,Player), self.entities):
-            visible.update(visibility(obs, pl.get_pos(), valid, self.height, self.width, self.visibility_dis))
+    def occupancy(self):
+        '''A fresh RayTable grid with every opaque entity marked.'''
+        rays = self.rays
+        if self.static_opaque is None:
+            grid = rays.new_grid()
+            for p in self.dormant_obs:
+                if self.pos_in_world(p):
+                    grid[rays.index(p.y, p.x)] = OPAQUE
+            self.static_opaque = grid
+        grid = bytearray(self.static_opaque)
+        for e in self.awake:
+            if not e.is_transparent():
+                p = e.get_pos()
+                if self.pos_in_world(p):
+                    grid[rays.index(p.y, p.x)] = OPAQUE
+        return grid
 
+    def calc_visibility(self):
+        rays = self.rays
+        grid = self.opaque = self.occupancy()
+        seen = set()
+        for pl in self.get_all_of_type(Player):
+            y, x = pl.get_pos()
+            seen |= rays.field_of_view(grid, y, x, self.visibility_dis, rand=self.rng.random)
+
+        stride = rays.stride
         vis_walls = set()
-        for v in visible:
-            if v in obs:continue
-            for n in v.get_neighbors():
-                if n in obs:
-                    vis_walls.add(n)
-        visible.update(vis_walls)
-        self.visible =visible #set(map(Entity.get_pos,self.entities))
+        for c in seen:
+            if grid[c] == OPEN:
+                for n in (c - stride, c + 1, c + stride, c - 1):
+                    if grid[n] == OPAQUE:
+                        vis_walls.add(n)
+        seen |= vis_walls
+
+        visible = BitGrid(self.height, self.width)
+        data = visible.data
+        explored = self.explored.data
+        r, width = rays.radius, self.width
+        for c in seen:
+            i = (c // stride - r) * width + c % stride - r
+            data[i >> 3] |= 1 << (i & 7)
+            explored[i >> 3] |= 1 << (i & 7)
+        self.visible = visible
+
+    def line_of_sight(self, a, b):
+        '''Whether b can be seen from a as of the last calc_visibility, None if they are too far apart to tell.'''
+        if self.opaque is None:
+            self.opaque = self.occupancy()
+        return self.rays.line_of_sight(self.opaque, a.y, a.x, b.y, b.x)
+
+    def is_wall(self, p):
+        '''Whether a dormant opaque entity, a wall, stands at p.'''
+        if self.static_opaque is None:
+            self.occupancy()
+        return self.pos_in_world(p) and self.static_opaque[self.rays.index(p.y, p.x)] == OPAQUE
 
     def pos_in_world(self, p):
         return p.y >= 0 and p.y < self.height and p.x >= 0 and p.x < self.width
 
     def get_draws(self):
+        '''
+        Returns (draws, vacated). draws holds (layer, chars) for the visible entities whose render version changed
+        or that just became visible, vacated the (layer, cell) pairs whose previously drawn chars no longer belong
+        there. Chars are cached per entity, and whatever else is drawn on a vacated cell of the same layer is
+        drawn again; the layers underneath take care of themselves.
+        '''
+        cache = self.draw_cache
+        drawn_at = self.drawn_at
+        draws = []
+        vacated = []
+
+        for e in cache.keys() - self.visible_ent:
+            version, cells, chars, layer = cache.pop(e)
+            for p in cells:
+                drawn_at[(layer, p)].discard(e)
+                vacated.append((layer, p))
+
         for e in self.visible_ent:
-            yield e.get_chars()
+            version = e.get_render_version()
+            cached = cache.get(e)
+            if cached is not None:
+                if cached[0] == version:
+                    continue
+                for p in cached[1]:
+                    drawn_at[(cached[3], p)].discard(e)
+                    vacated.append((cached[3], p))
+            chars = e.get_chars()
+            layer = e.get_draw_priority()
+            cells = [tuple(bc.pos) for bc in chars]
+            cache[e] = (version, cells, chars, layer)
+            for p in cells:
+                drawn_at[(layer, p)].add(e)
+            draws.append((layer, chars))
+
+        redrawn = set()
+        for key in vacated:
+            for e in drawn_at.get(key, ()):
+                if e not in redrawn and cache[e][0] == e.get_render_version():
+                    redrawn.add(e)
+                    draws.append((cache[e][3], cache[e][2]))
+        return draws, vacated
 
     def update(self):
         survived = []
+        sleeping = []
+        died = False
         self.visible_ent = set()
-        snp = defaultdict(list)
-        by_type = defaultdict(list)
-        for e in self.entities:
+        self.buffs.update(self)
+        self.scheduler.advance()
+        self.wake_pending()
+        #dormant cells and types start out as shared tuples and are copied into lists only when an awake entity joins
+        snp = defaultdict(list, self.dormant_at)
+        by_type = defaultdict(list, self.dormant_by_type)
+        planned = self.ai is None
+        for e in self.awake:
+            if not planned and isinstance(e, Spooker):
+                players = self.get_all_of_type(Player)
+                if players:
+                    self.ai.plan(self, players[0].get_pos(), self.get_all_of_type(Spooker))
+                planned = True
             e.update()
-            if e.get_pos() in self.visible:
+            pos = e.get_pos()
+            if pos in self.visible:
                 self.visible_ent.add(e)
 
             if not e.is_dead():
-                survived.append(e)
-                snp[e.get_pos()].append(e)
-                for t in inspect.getmro(type(e)):
-                    by_type[t].append(e)
+                if e.is_dormant():
+                    sleeping.append(e)
+                else:
+                    survived.append(e)
+                cell = snp[pos]
+                if type(cell) is tuple:
+                    cell = snp[pos] = list(cell)
+                cell.append(e)
+                for t in type(e).__mro__:
+                    group = by_type[t]
+                    if type(group) is tuple:
+                        group = by_type[t] = list(group)
+                    group.append(e)
             else:
-                SharedContext.get_instance().log(e.__class__.__name__+" has died at " + str(e.get_pos()))
-
-        self.entities = survived
+                died = True
+                self.order.pop(e)
+                ctx = self.ctx
+                ctx.deregister_all(e)
+                self.buffs.remove_all(e)
+                self.animations.stop_all(e)
+                self.spatial.remove(e)
+                ctx.log(e.__class__.__name__+" has died at " + str(e.get_pos()))
+
+        if self.ai is not None:
+            self.ai.finish()
+        if self.animations.paused:
+            self.animations.resume(self.visible_ent)
+        if sleeping:
+            self._index_dormant(sleeping)
+        dormant_at = self.dormant_at
+        for p in self.visible:
+            if p in dormant_at:
+                self.visible_ent.update(dormant_at[p])
+        for e in survived: #whatever shares a cell with a dormant entity gets it woken up for a look
+            if e.get_pos() in dormant_at:
+                self.waking.update(dormant_at[e.get_pos()])
+
+        if died:
+            self.entities = [e for e in self.entities if e in self.order]
+        self.awake = survived
         self.by_type = by_type
         self.cached_snapshot = snp
 
@@ -423,7 +1194,7 @@ class Entity(object): #base class
 
         self.pos = pos
         self.cached_pos = pos.rounded()
-        self.buffs = set()
+        self.render_version = 0
 
     def is_transparent(self):
         return True
@@ -431,26 +1202,52 @@ class Entity(object): #base class
     def get_pos(self):
         return self.cached_pos
         
+    color = 0
+
     def get_color_pair(self):
-        return 0
+        return self.color
 
     def get_str(self):
         return 'E'
 
-    def get_draw_priority(self): #behavior not implemented
-        return 0
+    def get_draw_priority(self):
+        '''The DrawController layer the entity is drawn on.'''
+        return ACTORS
+
+    def get_light(self):
+        '''(radius, intensity between 0 and 1) if the entity gives off light while awake, see lighting.LightMap.'''
+        return None
+
+    glyph = None #set while an animation overrides get_str(), see animation.Animator
+    tint = None #same for get_color_pair()
 
     def get_chars(self):
-        return [BufferedChar(self.get_pos(), self.get_str(), self.get_color_pair())]
+        ch = self.get_str() if self.glyph is None else self.glyph
+        co = self.get_color_pair() if self.tint is None else self.tint
+        return [BufferedChar(self.get_pos(), ch, co)]
+
+    def get_render_version(self):
+        '''Changes whenever get_chars() would return something different.'''
+        return self.render_version
+
+    def touch(self):
+        '''Call after changing anything get_str() or get_color_pair() depend on.'''
+        self.render_version += 1
 
     def update(self):
-        to_remove = set()
-        for b in self.buffs:
-            b.tick()
-            if b.get_duration() == 0:
-                to_remove.add(b)
-                b.cleanup()
-        self.buffs -= to_remove
+        pass
+
+    def is_dormant(self):
+        '''True when update() has nothing to do until something enters this cell, see World.wake.'''
+        return False
+
+    world = None
+    clock = Scheduler() #never advances, stands in until the entity is added to a world
+
+    def bind(self, world):
+        '''Called by World.add. Moves the entity onto the world's scheduler, keeping what is left of its cooldowns.'''
+        self.world = world
+        self.clock = world.scheduler
 
     def copy(self):
         return self
@@ -461,6 +1258,9 @@ class Entity(object): #base class
     def set_pos(self, p):
         self.pos = p
         self.cached_pos = p.rounded()
+        self.render_version += 1
+        if self.world is not None:
+            self.world.spatial.move(self, self.cached_pos)
 
     def is_collidable(self):
         return True
@@ -470,24 +1270,20 @@ class Entity(object): #base class
 
     def receive_buff(self, buff):
         buff.apply()
-        for b in self.buffs:
-            if type(buff) == type(b):
-                b.set_duration(b.get_duration() + buff.get_duration())
-                break
-        else:
-            self.buffs.add(buff)
+        self.world.buffs.add(self, buff)
 
     def get_buffs(self):
-        return self.buffs
+        return self.world.buffs.get_buffs(self)
 
 class MobileEntity(Entity):
 
     def __init__(self, pos):
         super(MobileEntity, self).__init__(pos)
 
-        self.rom_timer = 0
+        self.move_ready = 0 #tick on the clock from which moving is allowed again
         self.base_rom = 0
         self.last_direction = 0
+        self.plan = None
 
     def get_base_rom(self):
         return self.base_rom
@@ -496,10 +1292,15 @@ class MobileEntity(Entity):
         self.base_rom = new_val
 
     def get_rom_timer(self):
-        return self.rom_timer
+        return max(0, self.move_ready - self.clock.now)
 
     def set_rom_timer(self, new_val):
-        self.rom_timer = new_val
+        self.move_ready = self.clock.now + new_val
+
+    def bind(self, world):
+        left = self.get_rom_timer()
+        super(MobileEntity, self).bind(world)
+        self.set_rom_timer(left)
 
     def get_last_direction(self):
         return self.last_direction
@@ -507,11 +1308,11 @@ class MobileEntity(Entity):
     def try_move(self, direction):
         self.last_direction = direction
         if self.get_rom_timer() == 0:
-            ctx = SharedContext.get_instance()
+            ctx = self.world.ctx
             all_units = ctx.get_snapshot()
 
             new_pos = self.get_pos() + Pair.get_direction(direction)
-            if len(filter(lambda e:e.is_collidable(), all_units[new_pos])) > 0:
+            if any(e.is_collidable() for e in all_units[new_pos]):
                 return False
             else:
                 self.set_pos(new_pos)
@@ -527,50 +1328,59 @@ class MobileEntity(Entity):
             self.set_rom_timer(self.get_base_rom())
 
     def can_move(self, pos):
-        ctx = SharedContext.get_instance()
+        ctx = self.world.ctx
         all_units = ctx.get_snapshot()
-        return len(filter(lambda e:e.is_collidable(), all_units[pos])) == 0
+        return not any(e.is_collidable() for e in all_units[pos])
+
+    def get_planned(self, kind, pos):
+        '''Direction a planner already chose for this tick, -1 to stay put, None if it left the choice to us.'''
+        if self.plan is None:
+            return None
+        return self.plan.get((kind, pos.y, pos.x))
 
     def move_toward(self, pos):
+        if self.get_rom_timer() != 0: #still cooling down, whichever way we picked would be refused
+            return
+        d = self.get_planned(0, pos)
+        if d is not None:
+            if d >= 0:
+                self.try_move(d)
+            return
+
         min_p = None
         for n in self.get_pos().get_neighbors():
-            if self.can_move(n) and (min_p is None or n.euclidean(pos) < min_p.euclidean(pos)):
+            if self.can_move(n) and (min_p is None or n.dist2(pos) < min_p.dist2(pos)):
                 min_p = n
 
-        if self.get_pos().euclidean(pos) < min_p.euclidean(pos):
+        if self.get_pos().dist2(pos) < min_p.dist2(pos):
             return
         if min_p is not None:
             self.try_move(self.get_pos().direction_to(min_p))
 
     def move_away(self, pos):
+        if self.get_rom_timer() != 0:
+            return
+        d = self.get_planned(1, pos)
+        if d is not None:
+            if d >= 0:
+                self.try_move(d)
+            return
+
         max_p = None
         for n in self.get_pos().get_neighbors():
-            if self.can_move(n) and (max_p is None or n.euclidean(pos) > max_p.euclidean(pos)):
+            if self.can_move(n) and (max_p is None or n.dist2(pos) > max_p.dist2(pos)):
                 max_p = n
         if max_p is not None:
 
             self.try_move(self.get_pos().direction_to(max_p))
 
-    def update(self):
-        super(MobileEntity, self).update()
-
-        self.set_rom_timer(max(0, self.get_rom_timer()-1))
-
 class Player(MobileEntity):
 
     def __init__(self, pos):
         super(Player, self).__init__(pos)
 
-        ctx = SharedContext.get_instance()
-
-        ctx.register_key(KeyHandler(self, curses.KEY_UP, lambda k:self.try_move(UP)))
-        ctx.register_key(KeyHandler(self, curses.KEY_RIGHT, lambda k:self.try_move(RIGHT)))
-        ctx.register_key(KeyHandler(self, curses.KEY_DOWN, lambda k:self.try_move(DOWN)))
-        ctx.register_key(KeyHandler(self, curses.KEY_LEFT, lambda k:self.try_move(LEFT)))
-        ctx.register_key(KeyHandler(self, ord(' '), lambda k:self.shoot())) #spacebar
-
         self.base_rof = 25
-        self.rof_timer = 0
+        self.fire_ready = 0
 
         self.set_base_rom(2)
 
@@ -579,8 +1389,7 @@ class Player(MobileEntity):
     def get_str(self):
         return '&'
 
-    def get_color_pair(self):
-        return ColorController.get_color('magenta', 'white')
+    color = ColorController.get_color('magenta', 'white')
 
     def is_collidable(self):
         return False
@@ -596,18 +1405,42 @@ class Player(MobileEntity):
 
     def set_base_rof(self, new_rof):
         self.base_rof = new_rof
-        self.rof_timer = min(self.rof_timer, new_rof)
+        self.set_rof_timer(min(self.get_rof_timer(), new_rof))
+
+    def get_rof_timer(self):
+        return max(0, self.fire_ready - self.clock.now)
+
+    def set_rof_timer(self, new_val):
+        self.fire_ready = self.clock.now + new_val
+
+    def bind(self, world):
+        '''Keys go to the context of the world the player is in, and follow it to the next level.'''
+        if self.world is not None:
+            self.world.ctx.deregister_all(self)
+        left = self.get_rof_timer()
+        super(Player, self).bind(world)
+        self.set_rof_timer(left)
+
+        world.ctx.register_keys([
+            KeyHandler(self, curses.KEY_UP, lambda k:self.try_move(UP)),
+            KeyHandler(self, curses.KEY_RIGHT, lambda k:self.try_move(RIGHT)),
+            KeyHandler(self, curses.KEY_DOWN, lambda k:self.try_move(DOWN)),
+            KeyHandler(self, curses.KEY_LEFT, lambda k:self.try_move(LEFT)),
+            KeyHandler(self, ord(' '), lambda k:self.shoot()) #spacebar
+        ])
+
+    def get_light(self):
+        return (self.world.visibility_dis, 1.)
 
     def shoot(self):
-        if self.rof_timer == 0:
-            SharedContext.get_instance().add_entity(Fireball(self.get_pos(), self.get_last_direction()))
-            self.rof_timer = self.base_rof
+        if self.get_rof_timer() == 0:
+            self.world.ctx.add_entity(Fireball(self.get_pos(), self.get_last_direction()))
+            self.set_rof_timer(self.base_rof)
 
     def update(self):
         super(Player,self).update()
-        self.rof_timer = max(0, self.rof_timer-1)
 
-        here = SharedContext.get_instance().get_snapshot()[self.get_pos()]
+        here = self.world.ctx.get_snapshot()[self.get_pos()]
         for a in here:
             if isinstance(a, Spooker):
                 self.hp -= 1
@@ -619,30 +1452,35 @@ class Player(MobileEntity):
 
 class Spooker(MobileEntity):
     
-    def __init__(self, pos):
+    def __init__(self, pos, pth=None):
         super(Spooker, self).__init__(pos)
         self.moodController = SpookerMoodController(self)
         self.set_base_rom(5)
-        self.rom_timer = 0
 
         self.hp = 100
 
-        self.flash_timer = 0
+        self.pth = pth #patrol route, worked out once added to a world if not given
 
-        ctx = SharedContext.get_instance()
-        walls = set(map(Entity.get_pos, ctx.get_world().get_all_of_type(Wall)))
-        height, width = ctx.get_world_bounds()
-        self.pth = get_route(pos, walls)
 
+    color = ColorController.get_color('red', 'white')
+    flash = Track([(None, ColorController.get_color('black', 'white')),
+        (None, ColorController.get_color('white', 'black'))], period=2) #while next to the player
 
-    def get_color_pair(self):
-        player = SharedContext.get_instance().get_player_pos()[0]
-        if self.get_pos().euclidean(player.get_pos()) < 2:
-            if self.flash_timer % 4 < 2:
-                return ColorController.get_color('black', 'white')
+    def bind(self, world):
+        super(Spooker, self).bind(world)
+        if self.pth is None:
+            walls = set(map(Entity.get_pos, world.get_all_of_type(Wall)))
+            self.pth = get_route(self.get_pos(), walls)
+
+    def update_color(self):
+        player = self.world.ctx.get_player_pos()[0]
+        near = self.get_pos().dist2(player.get_pos()) < 4
+        animations = self.world.animations
+        if near != animations.is_playing(self, 'flash'):
+            if near:
+                animations.play(self, 'flash', self.flash)
             else:
-                return ColorController.get_color('white', 'black')
-        return ColorController.get_color('red', 'white')
+                animations.stop(self, 'flash')
 
     def is_transparent(self):
         return False
@@ -651,9 +1489,7 @@ class Spooker(MobileEntity):
         return not isinstance(self.moodController.mood, BoredMood)
 
     def update(self):
-        self.flash_timer += 1
-
-        all_pos = SharedContext.get_instance().get_snapshot()
+        all_pos = self.world.ctx.get_snapshot()
         if any([isinstance(p,Fireball) for p in all_pos[self.get_pos()]]):
             self.hp -= 50
             if self.hp == 0:
@@ -662,7 +1498,7 @@ class Spooker(MobileEntity):
 
         self.moodController.update()
 
-        self.rom_timer = max(0,self.rom_timer-1)
+        self.update_color()
         
     def is_dead(self):
         return self.hp <= 0
@@ -697,32 +1533,32 @@ class SpookerMood(object):
 class AngryMood(SpookerMood):
 
     def transition(self):
-        ctx = SharedContext.get_instance()
+        ctx = self.unit.world.ctx
         me = self.unit.get_pos()
         if me not in ctx.get_visible_posns():
             return BoredMood(self.unit)
         pl = ctx.get_player_pos()[0].get_pos()
-        if me.euclidean(pl) > 8:
+        if me.dist2(pl) > 64:
             return SpookedMood(self.unit)
 
     def apply(self):
-        ctx = SharedContext.get_instance()
+        ctx = self.unit.world.ctx
         pl = ctx.get_player_pos()[0].get_pos()
         self.unit.move_toward(pl)
 
 class SpookedMood(SpookerMood):
 
     def transition(self):
-        ctx = SharedContext.get_instance()
+        ctx = self.unit.world.ctx
         me = self.unit.get_pos()
         if me not in ctx.get_visible_posns():
             return BoredMood(self.unit)
         pl = ctx.get_player_pos()[0].get_pos()
-        if me.euclidean(pl) <= 8:
+        if me.dist2(pl) <= 64:
             return AngryMood(self.unit)
 
     def apply(self):
-        ctx = SharedContext.get_instance()
+        ctx = self.unit.world.ctx
         pl = ctx.get_player_pos()[0].get_pos()
         self.unit.move_away(pl)
 
@@ -732,11 +1568,11 @@ class BoredMood(SpookerMood):
         self.pthindex = 0
 
     def transition(self):
-        ctx = SharedContext.get_instance()
+        ctx = self.unit.world.ctx
         me = self.unit.get_pos()
         if me in ctx.get_visible_posns():
             pl = ctx.get_player_pos()[0].get_pos()
-            if me.euclidean(pl) <= 8:
+            if me.dist2(pl) <= 64:
                 return AngryMood(self.unit)
             else:
                 return SpookedMood(self.unit)
@@ -753,23 +1589,15 @@ class BoredMood(SpookerMood):
             self.unit.move_toward(self.unit.pth[self.pthindex])
 
 class FastSpooker(Spooker):
+    color = ColorController.get_color('blue', 'white')
 
-    def __init__(self, pos):
-        super(FastSpooker, self).__init__(pos)
+    def __init__(self, pos, pth=None):
+        super(FastSpooker, self).__init__(pos, pth=pth)
 
         self.set_base_rom(3)
 
         self.hp = 50
 
-    def get_color_pair(self):
-        player = SharedContext.get_instance().get_player_pos()[0]
-        if self.get_pos().euclidean(player.get_pos()) < 2:
-            if self.flash_timer % 4 < 2:
-                return ColorController.get_color('black', 'white')
-            else:
-                return ColorController.get_color('white', 'black')
-        return ColorController.get_color('blue', 'white')
-
 class Fireball(MobileEntity):
     def __init__(self, pos, direction):
         super(Fireball, self).__init__(pos)
@@ -779,19 +1607,24 @@ class Fireball(MobileEntity):
 
         self.set_base_rom(2)
 
-    def get_color_pair(self):
-        return ColorController.get_color('red', 'yellow')
+    color = ColorController.get_color('red', 'yellow')
 
     def get_str(self):
         return 'O'
 
+    def get_light(self):
+        return (4, .6)
+
+    def get_draw_priority(self):
+        return EFFECTS
+
     def is_collidable(self):
         return False
 
     def update(self):
         super(Fireball, self).update()
 
-        ctx = SharedContext.get_instance()
+        ctx = self.world.ctx
         here = ctx.get_snapshot()[self.get_pos()]
         for h in here:
             if h.is_collidable():
@@ -816,12 +1649,17 @@ class Wall(Entity):
     def is_transparent(self):
         return False
 
-    def get_color_pair(self):
-        return ColorController.get_color('green', 'green')
+    def is_dormant(self):
+        return True
+
+    color = ColorController.get_color('green', 'green')
 
     def get_str(self):
         return ' '
 
+    def get_draw_priority(self):
+        return TERRAIN
+
 class BreakableWall(Wall):
 
     def __init__(self, pos):
@@ -832,17 +1670,16 @@ class BreakableWall(Wall):
     def get_str(self):
         return '#'
 
-    def get_color_pair(self):
-        return ColorController.get_color("black","green")
+    color = ColorController.get_color("black","green")
 
     def update(self):
-        ctx = SharedContext.get_instance()
-        fireballs = ctx.get_world().get_all_of_type(Fireball)
+        ctx = self.world.ctx
+        fireballs = self.world.get_all_of_type(Fireball)
         if any([f.get_pos() == self.get_pos() for f in fireballs]):
             self.hp -= 1
         if self.hp == 0:
-            t = random.choice(powerup_types)
-            ctx.add_entity(Potion(self.get_pos(), t, powerup_durations[t]))
+            t = self.world.rng.choice(powerup_types)
+            ctx.add_entity(Potion(self.get_pos(), t, self.world.powerup_durations[t]))
 
     def is_dead(self):
         return not bool(self.hp)
@@ -860,7 +1697,7 @@ class Potion(Entity):
 
     def update(self):
         super(Potion, self).update()
-        ctx = SharedContext.get_instance()
+        ctx = self.world.ctx
         player = ctx.get_player_pos()[0]
         if self.get_pos() == player.get_pos():
             player.receive_buff(self.bufftype(player, self.duration))
@@ -872,29 +1709,110 @@ class Potion(Entity):
     def get_str(self):
         return 'U'
 
-    def get_color_pair(self):
-        return ColorController.get_color('black', 'white')
+    def get_light(self):
+        return (2, .4)
+
+    def get_draw_priority(self):
+        return ITEMS
+
+    color = ColorController.get_color('black', 'white')
 
     def is_collidable(self):
         return False
 
+class BuffManager():
+    '''
+    Every buff of a world, indexed by (entity, buff type). Expiries are scheduled on the world's Scheduler, keyed
+    on the absolute tick, so a buff costs nothing between being received and running out. Buff types with a per
+    frame effect (per_frame = True) get one frame() call per type per tick, however many entities carry them.
+    '''
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.by_entity = {}
+        self.per_frame = defaultdict(set)
+
+    def get_now(self):
+        return self.scheduler.now
+
+    def add(self, unit, buff):
+        '''Starts buff on unit, or extends unit's existing buff of the same type by buff's duration.'''
+        held = self.by_entity.setdefault(unit, {})
+        current = held.get(type(buff))
+        if current is not None:
+            current.set_duration(current.get_duration() + buff.get_duration())
+            return
+        held[type(buff)] = buff
+        buff.manager = self
+        buff.set_duration(buff.duration)
+        if buff.per_frame:
+            self.per_frame[type(buff)].add(buff)
+
+    def schedule(self, buff):
+        expires = buff.expires
+        self.scheduler.call_at(expires, lambda: self._expire(buff, expires))
+
+    def _expire(self, buff, expires):
+        if buff.manager is self and buff.expires == expires: #set_duration leaves the old deadline behind
+            self._drop(buff.unit, buff)
+            buff.cleanup()
+
+    def get_buffs(self, unit):
+        return list(self.by_entity.get(unit, {}).values())
+
+    def _drop(self, unit, buff):
+        held = self.by_entity[unit]
+        held.pop(type(buff))
+        if not held:
+            self.by_entity.pop(unit)
+        self.per_frame[type(buff)].discard(buff)
+        buff.manager = None
+
+    def remove_all(self, unit):
+        '''Forgets unit's buffs without cleaning them up, for units that died.'''
+        for b in self.get_buffs(unit):
+            self._drop(unit, b)
+
+    def transfer(self, unit, other):
+        '''Moves unit's buffs, with their remaining durations, to another manager.'''
+        for b in self.get_buffs(unit):
+            left = b.get_duration()
+            self._drop(unit, b)
+            b.duration = left
+            other.add(unit, b)
+
+    def update(self, world):
+        for typ, buffs in self.per_frame.items():
+            if buffs:
+                typ.frame(world, buffs)
+
 class Buff(object):
+    per_frame = False
+
     def __init__(self, unit, duration):
         self.unit = unit
         self.duration = duration
+        self.manager = None
+        self.expires = None
 
     def get_duration(self):
-        return self.duration
+        if self.manager is None:
+            return self.duration
+        return self.expires - self.manager.get_now()
 
     def set_duration(self, d):
         self.duration = d
+        if self.manager is not None:
+            self.expires = self.manager.get_now() + d
+            self.manager.schedule(self)
 
     def apply(self):
         say(self.__class__.__name__)
         return 
 
-    def tick(self):
-        self.duration -= 1
+    @classmethod
+    def frame(cls, world, buffs):
+        '''Per frame effect of every active buff of this type, only called when per_frame is set.'''
+        pass
 
     def cleanup(self):
         return 
@@ -936,79 +1854,181 @@ class Sith(Buff):
         self.unit.set_base_rof(self.old_base_rof)
 
 class Vision(Buff):
-    def tick(self):
-        super(Vision, self).tick()
-        world = SharedContext.get_instance().get_world()
+    per_frame = True
+
+    @classmethod
+    def frame(cls, world, buffs):
         world.visible_ent |= set(world.get_all_of_type(Spooker))
-        self.w = world
 
 class Lantern(Buff):
     def apply(self):
         super(Lantern,self).apply()
-        world = SharedContext.get_instance().get_world()
+        world = self.unit.world
         self.old_dis = world.visibility_dis
         world.visibility_dis = 16
 
     def cleanup(self):
-        world = SharedContext.get_instance().get_world()
+        world = self.unit.world
         world.visibility_dis = self.old_dis
 
 powerup_types = [Haste, Ghost, Vision, Vision, Lantern]
 powerup_durations = {Vision:15, Haste:200, Sith:350, Ghost:150, Lantern:200}
 
 def say(s, v = 'veena'):
-    if say.no_sound:return
-    try:
-        t = Thread(target=lambda:os.system('say -v %s "%s"'%(v,s)))
-        t.start()
-    except:
-        say.no_sound = True
-say.no_sound = False
+    AudioDispatcher.get_instance().say(s, v)
 
-def main():
-    try:
+def build_level(world, rng=random, enemy_density=.5, powerup_density=.2):
+    '''
+    Fills world with a freshly generated dungeon: walls, monsters and potions, and sets world.rooms to its RoomGraph.
+    Touches no shared state besides rng.
+    '''
+    walls, en, powerups, rooms = dungeon.weird_dungeon(world.height, world.width, enemy_density=enemy_density,
+        powerup_density=powerup_density, rng=rng)
+    wall_pos = []
+    for i in range(world.height):
+        for j in range(world.width):
+            if walls[i][j]:
+                wall_pos.append(Pair(i,j))
+    wall_set = set(wall_pos)
+
+    en = [Pair(p[0], p[1]) for p in en]
+    powerups = [Pair(p[0], p[1]) for p in powerups]
+
+    for w in wall_pos:
+        if rng.random() < .995:
+            wa = Wall(w)
+        else:
+            wa = BreakableWall(w)
+        world.add(wa)
 
-        mc = MainController(world_height=60, world_width=180)
-        player = Player(Pair(30,90))
-        mc.w.add(player)
-        walls, en, powerups, rooms = dungeon.weird_dungeon(mc.w.height, mc.w.width, powerup_density=.2)
-        wall_pos = []
-        for i in range(mc.w.height):
-            for j in range(mc.w.width):
-                if walls[i][j]:
-                    wall_pos.append(Pair(i,j))
-
-        en = map(lambda p:Pair(p[0], p[1]), en)
-        powerups = map(lambda p:Pair(p[0], p[1]), powerups)
-
-        for w in wall_pos:
-            if random.random() < .995:
-                wa = Wall(w)
-            else:
-                wa = BreakableWall(w)
-            mc.w.add(wa)
+    for e in en:
+        t = rng.choice([Spooker, FastSpooker])
+        if t == FastSpooker:
+            world.add(FastSpooker(e, pth=get_route(e, wall_set)))
+        elif t == Spooker:
+            world.add(Spooker(e, pth=get_route(e, wall_set)))
+
+    for p in powerups:
+        tp = rng.choice(powerup_types)
+        pot = Potion(p, tp, world.powerup_durations[tp])
+        world.add(pot)
 
-        for e in en:
-            t = random.choice([Spooker, FastSpooker])
-            if t == FastSpooker:
-                mc.w.add(FastSpooker(e))
-            elif t == Spooker:
-                mc.w.add(Spooker(e))
+    world.rooms = RoomGraph(walls, rooms)
+
+class LevelLoader():
+    '''
+    Builds levels, each from its own Random seeded from (seed, level number), and hands them out in order.
+    With background=True a worker thread builds them, and the next level starts building as soon as the
+    current one is handed out, so it is usually ready before it is needed.
+    '''
+    def __init__(self, height, width, seed, background=True):
+        self.height = height
+        self.width = width
+        self.seed = seed
+        self.background = background
+        self.count = 0
+        self.built = queue.Queue()
+
+        if background:
+            self.requests = queue.Queue()
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+        self._request()
+
+    def _build(self, n):
+        world = World(self.height, self.width)
+        build_level(world, random.Random('%d:%d' % (self.seed, n)))
+        return world
+
+    def _run(self):
+        while True:
+            self.built.put(self._build(self.requests.get()))
 
-        for p in powerups:
-            tp = random.choice(powerup_types)
-            pot = Potion(p, tp, powerup_durations[tp])
-            mc.w.add(pot)
+    def _request(self):
+        n = self.count
+        self.count += 1
+        if self.background:
+            self.requests.put(n)
+        else:
+            self.built.put(self._build(n))
+
+    def get(self):
+        try:
+            world = self.built.get_nowait()
+        except queue.Empty:
+            return None
+        self._request()
+        return world
+
+def new_game(mc, seed, background=False):
+    '''Seeds the global random and queues up the levels. Same seed and same input give the same game.'''
+    random.seed(seed)
+    mc.set_level_source(LevelLoader(mc.w.height, mc.w.width, seed, background=background))
+
+def _arg_value(flag, default=None):
+    if flag in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
+
+def main(seed=None, record_path=None, ai_procs=None, ansi=False, spectate=None):
+    '''spectate is a TCP port on localhost or a Unix socket path to stream the game to, see spectate.py.'''
+    mc = None
+    screen = None
+    spectators = None
+    startup = None
+    if seed is None:
+        seed = random.randrange(2**32)
+    try:
+
+        if ansi:
+            screen = AnsiScreen()
+            screen.start()
+        mc = MainController(world_height=60, world_width=180, screen=screen)
+        mc.ctx.log('Seed %d' % seed)
+        if ai_procs:
+            from parallel_ai import AIPool
+            mc.w.set_ai(AIPool(mc.w.height, mc.w.width, processes=ai_procs))
+        new_game(mc, seed, background=True)
+        if record_path is not None:
+            from replay import Recorder
+            mc.recorder = Recorder(record_path, seed, mc.w.height, mc.w.width)
+        if spectate is not None:
+            from spectate import SpectatorServer
+            if spectate.isdigit():
+                server = SpectatorServer(mc.dc, port=int(spectate))
+            else:
+                server = SpectatorServer(mc.dc, path=spectate)
+            spectators = server.start() #only stopped in the finally below once it started
 
         mc.dc.full_draw()
-        while not player.is_dead():
-            mc.tock()
+        mc.tock()
+        startup = 'First frame %.1fms after import' % ((time() - _import_started) * 1000)
+        mc.ctx.log(startup)
+        while mc.get_player() is None or not mc.get_player().is_dead():
             sleep(TIME_UNIT)
+            mc.tock()
     finally:
-        curses.endwin()
-        # print 'Logged:',SharedContext.get_instance().log_list
-
-if len(sys.argv) < 2 or sys.argv[1] != 'no':
+        try:
+            if spectators is not None:
+                spectators.stop()
+            if mc is not None:
+                mc.input.stop()
+                if mc.recorder is not None:
+                    mc.recorder.close()
+                if mc.w.ai is not None:
+                    mc.w.ai.close()
+                mc.dc.close()
+            elif not ansi:
+                curses.endwin()
+        finally:
+            if screen is not None: #whatever failed, leave the terminal usable
+                screen.close()
+        if '--timing' in sys.argv:
+            print(startup or 'No frame was drawn')
+        # print('Logged:', mc.ctx.log_list)
+
+def intro():
 
     story = [
     "Long ago there existed a peaceful village.", 
@@ -1039,14 +2059,21 @@ if len(sys.argv) < 2 or sys.argv[1] != 'no':
 
     '''
 
-    print flower
+    print(flower)
     for l in story:
-        print l
-        try:
-            os.system('say -v veena "%s"'%l)
-        except:
-            pass
-
-    raw_input('Press enter to start')
-
-main()
\ No newline at end of file
+        print(l)
+        say(l)
+        AudioDispatcher.get_instance().flush()
+
+    input('Press enter to start')
+
+if __name__ == '__main__':
+    #replay, parallel_ai and spectate import terminal_engine; make that this module instead of a second copy whose
+    #classes (Wall, Spooker, ColorController, ...) would not be the ones the running game uses
+    sys.modules['terminal_engine'] = sys.modules['__main__']
+    if len(sys.argv) < 2 or sys.argv[1] != 'no':
+        intro()
+    seed = _arg_value('--seed')
+    ai_procs = _arg_value('--ai-procs')
+    main(seed=None if seed is None else int(seed), record_path=_arg_value('--record'),
+        ai_procs=None if ai_procs is None else int(ai_procs), ansi='--ansi' in sys.argv, spectate=_arg_value('--spectate'))
@@ -1,6 +1,8 @@
 import random
-from collections import deque
+from collections import deque, defaultdict, OrderedDict
 import heapq
+import re
+from array import array
 UP = 0
 RIGHT = 1
 DOWN = 2
@@ -33,6 +35,9 @@ class Pair():
 
         return  (self.y==other.y and self.x==other.x)
 
+    def __lt__(self, other):
+        return (self.y, self.x) < (other.y, other.x)
+
     def __hash__(self):
         return (self.y,self.x).__hash__()
 
@@ -63,6 +68,11 @@ class Pair():
     def euclidean(self, other):
         return ((self.y-other.y)**2 + (self.x-other.x)**2)**.5
 
+    def dist2(self, other):
+        '''Squared euclidean distance, exact in integers. Compare it against r*r instead of euclidean against r.'''
+        dy, dx = self.y - other.y, self.x - other.x
+        return dy*dy + dx*dx
+
     def direction_to(self, other):
         diff =  other - self
         if abs(diff.y) > abs(diff.x):
@@ -97,45 +107,446 @@ class BufferedChar():
 
 
 
+_nonzero = re.compile(b'[^\x00]')
+
+class BitGrid():
+    '''
+    A set of cells of a height x width grid, packed one bit per cell: row major, least significant bit first.
+    Membership is a byte lookup, while xor, union, intersection and len run over the whole grid at C speed.
+    Iterating yields the set cells as Pairs, skipping empty bytes wholesale.
+    '''
+    def __init__(self, height, width, data=None):
+        self.height = height
+        self.width = width
+        if data is None:
+            data = bytearray((height * width + 7) // 8)
+        self.data = bytearray(data)
+
+    def _bit(self, p):
+        y, x = p.y, p.x
+        if 0 <= y < self.height and 0 <= x < self.width:
+            return y * self.width + x
+        return None
+
+    def add(self, p):
+        i = self._bit(p)
+        if i is not None:
+            self.data[i >> 3] |= 1 << (i & 7)
+
+    def discard(self, p):
+        i = self._bit(p)
+        if i is not None:
+            self.data[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+    def __contains__(self, p):
+        i = self._bit(p)
+        return i is not None and self.data[i >> 3] >> (i & 7) & 1 == 1
+
+    def _as_int(self):
+        return int.from_bytes(self.data, 'little')
+
+    def _wrap(self, value):
+        return BitGrid(self.height, self.width, value.to_bytes(len(self.data), 'little'))
+
+    def __xor__(self, other):
+        return self._wrap(self._as_int() ^ other._as_int())
+
+    def __or__(self, other):
+        return self._wrap(self._as_int() | other._as_int())
+
+    def __and__(self, other):
+        return self._wrap(self._as_int() & other._as_int())
+
+    def __eq__(self, other):
+        return isinstance(other, BitGrid) and self.data == other.data
+
+    def __len__(self):
+        return bin(self._as_int()).count('1')
+
+    def __bool__(self):
+        return self.data.count(0) != len(self.data)
+
+    def __iter__(self):
+        data, width = self.data, self.width
+        for m in _nonzero.finditer(data):
+            byte = data[m.start()]
+            base = m.start() << 3
+            for k in range(8):
+                if byte >> k & 1:
+                    yield Pair((base + k) // width, (base + k) % width)
+
+    def copy(self):
+        return BitGrid(self.height, self.width, self.data)
+
 class KeyHandler():
     def __init__(self, registree, key, callback):
         self.registree = registree 
         self.key = key
         self.callback = callback
 
-def get_line( p1,p2,obs,dis=8,extend_prob=.009):
-    y0,x0=p1
-    y1,x1=p2
+class HandlerRegistry():
+    '''
+    KeyHandlers indexed by (key, registree), so adding or removing a registree's handlers does not scan the
+    handlers of everybody else. The key -> handlers dispatch table is only rebuilt after a change.
+    '''
+    def __init__(self):
+        self.handlers = OrderedDict()
+        self.by_registree = defaultdict(set)
+        self.table = {}
+        self.dirty = False
+
+    def add(self, handler):
+        slot = (handler.key, handler.registree)
+        if slot not in self.handlers:
+            self.handlers[slot] = []
+        self.handlers[slot].append(handler)
+        self.by_registree[handler.registree].add(handler.key)
+        self.dirty = True
+
+    def add_all(self, handlers):
+        for h in handlers:
+            self.add(h)
+
+    def remove(self, key, registree):
+        if self.handlers.pop((key, registree), None) is None:
+            return
+        keys = self.by_registree[registree]
+        keys.discard(key)
+        if not keys:
+            self.by_registree.pop(registree)
+        self.dirty = True
+
+    def remove_registree(self, registree):
+        '''Drops every handler belonging to registree, e.g. when it dies.'''
+        for key in self.by_registree.pop(registree, ()):
+            self.handlers.pop((key, registree), None)
+            self.dirty = True
+
+    def get_table(self):
+        if self.dirty:
+            table = defaultdict(list)
+            for (key, registree), hs in self.handlers.items():
+                table[key].extend(hs)
+            self.table = dict((k, tuple(v)) for k, v in table.items())
+            self.dirty = False
+        return self.table
+
+    def get(self, key):
+        return self.get_table().get(key, ())
+
+class TimerWheel():
+    '''
+    Hierarchical timing wheel keyed on absolute ticks. Level k has 2**bits slots of (2**bits)**k ticks each;
+    entries move down a level when their slot comes up, so scheduling is O(1) and advancing only touches the
+    entries that are due (plus the occasional cascade). Nothing is ever cancelled: owners should check that a
+    fired entry still matters.
+    '''
+    def __init__(self, levels=4, bits=6):
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.slots = [[[] for i in range(1 << bits)] for j in range(levels)]
+        self.overflow = []
+        self.now = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _insert(self, tick, item):
+        delta = tick - self.now
+        for level in range(len(self.slots)):
+            if delta < 1 << (self.bits * (level + 1)):
+                self.slots[level][(tick >> (self.bits * level)) & self.mask].append((tick, item))
+                return
+        self.overflow.append((tick, item))
+
+    def schedule(self, tick, item):
+        '''Fires item at the given absolute tick, or on the next advance if that tick has already passed.'''
+        self._insert(max(tick, self.now + 1), item)
+        self.count += 1
+
+    def advance(self):
+        '''Moves to the next tick and returns the items scheduled for it.'''
+        self.now += 1
+        now = self.now
+
+        top = 0
+        while top + 1 < len(self.slots) and not now & ((1 << (self.bits * (top + 1))) - 1):
+            top += 1
+        if top == len(self.slots) - 1 and not now & ((1 << (self.bits * len(self.slots))) - 1):
+            pending, self.overflow = self.overflow, []
+            for tick, item in pending:
+                self._insert(tick, item)
+        for level in range(top, 0, -1):
+            slot = (now >> (self.bits * level)) & self.mask
+            pending, self.slots[level][slot] = self.slots[level][slot], []
+            for tick, item in pending:
+                self._insert(tick, item)
+
+        slot = now & self.mask
+        due, self.slots[0][slot] = self.slots[0][slot], []
+        self.count -= len(due)
+        return [item for tick, item in due]
+
+class Scheduler():
+    '''
+    Runs callbacks at absolute ticks, on top of a TimerWheel. Cooldowns kept as "ready at tick T" deadlines
+    against now need no per tick bookkeeping at all.
+    '''
+    def __init__(self):
+        self.wheel = TimerWheel()
+        self.now = 0
+
+    def call_at(self, tick, callback):
+        '''Runs callback at the given tick, or on the next advance if that tick has already passed.'''
+        self.wheel.schedule(tick, callback)
+
+    def advance(self):
+        '''Moves to the next tick and runs whatever was due then.'''
+        due = self.wheel.advance()
+        self.now = self.wheel.now
+        for callback in due:
+            callback()
+
+class SpatialHash():
+    '''
+    Uniform grid of cell x cell buckets holding anything with get_pos(), filed under every type in its mro like
+    World.by_type. A query only visits the buckets around its position, so it costs about as much as its answer.
+    '''
+    def __init__(self, cell=8):
+        self.cell = cell
+        self.buckets = {} #type -> (bucket y, bucket x) -> list of objects
+        self.where = {} #object -> the bucket it is filed in
+
+    def insert(self, o):
+        p = o.get_pos()
+        key = (p.y // self.cell, p.x // self.cell)
+        self.where[o] = key
+        for t in type(o).__mro__:
+            self.buckets.setdefault(t, {}).setdefault(key, []).append(o)
+
+    def remove(self, o):
+        key = self.where.pop(o, None)
+        if key is None:
+            return
+        for t in type(o).__mro__:
+            buckets = self.buckets[t]
+            group = buckets[key]
+            group.remove(o)
+            if not group:
+                del buckets[key]
+
+    def move(self, o, p):
+        '''Call when o moved to p. Does nothing for objects that were never inserted.'''
+        old = self.where.get(o)
+        if old is None or old == (p.y // self.cell, p.x // self.cell):
+            return
+        self.remove(o)
+        self.insert(o)
+
+    def clear(self):
+        self.buckets = {}
+        self.where = {}
+
+    def within_radius(self, pos, r, typ=object):
+        '''Everything of type typ no further than r from pos.'''
+        buckets = self.buckets.get(typ)
+        if not buckets:
+            return []
+        c = self.cell
+        y, x, r2 = pos.y, pos.x, r * r
+        y0, y1, x0, x1 = (y - r) // c, (y + r) // c, (x - r) // c, (x + r) // c
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(buckets):
+            keys = [k for k in buckets if y0 <= k[0] <= y1 and x0 <= k[1] <= x1]
+        else:
+            keys = [(by, bx) for by in range(y0, y1 + 1) for bx in range(x0, x1 + 1) if (by, bx) in buckets]
+        res = []
+        for k in keys:
+            for o in buckets[k]:
+                p = o.get_pos()
+                dy, dx = p.y - y, p.x - x
+                if dy*dy + dx*dx <= r2:
+                    res.append(o)
+        return res
+
+    def nearest(self, pos, typ=object):
+        '''One of the closest objects of type typ to pos, None if there are none.'''
+        buckets = self.buckets.get(typ)
+        if not buckets:
+            return None
+        c = self.cell
+        y, x = pos.y, pos.x
+        cy, cx = y // c, x // c
+        last = max(max(abs(k[0] - cy), abs(k[1] - cx)) for k in buckets)
+        best, best_d = None, None
+        for ring in range(last + 1):
+            if ring == 0:
+                keys = [(cy, cx)]
+            else:
+                keys = [(cy + d, cx + e) for d in (-ring, ring) for e in range(-ring, ring + 1)]
+                keys += [(cy + d, cx + e) for e in (-ring, ring) for d in range(1 - ring, ring)]
+            for k in keys:
+                for o in buckets.get(k, ()):
+                    p = o.get_pos()
+                    dy, dx = p.y - y, p.x - x
+                    d = dy*dy + dx*dx
+                    if best is None or d < best_d:
+                        best, best_d = o, d
+            #anything in a further ring is at least ring*c + 1 away on one axis
+            if best is not None and best_d <= (ring * c + 1) ** 2:
+                break
+        return best
+
+OPEN = 0
+OPAQUE = 1
+OUTSIDE = 2
+
+def _bresenham(dy, dx):
+    "Cells of the line from (0, 0) to (dy, dx), origin excluded, in the order Bresenham's algorithm visits them"
     r = []
-    "Bresenham's line algorithm"
-    dx = abs(x1 - x0)
-    dy = abs(y1 - y0)
-    x, y = x0, y0
-    sx = -1 if x0 > x1 else 1
-    sy = -1 if y0 > y1 else 1
-    if dx > dy:
-        err = dx / 2.0
-        while x != x1:
-            if Pair(y, x)in obs or (((x-x0)**2 + (y-y0)**2 > dis**2) and random.random() > extend_prob):break
-            r.append(Pair(y, x))
-            err -= dy
+    x = y = 0
+    sx = -1 if dx < 0 else 1
+    sy = -1 if dy < 0 else 1
+    ax, ay = abs(dx), abs(dy)
+    if ax > ay:
+        err = ax / 2.0
+        while x != dx:
+            err -= ay
             if err < 0:
                 y += sy
-                err += dx
+                err += ax
             x += sx
+            r.append((y, x))
     else:
-        err = dy / 2.0
-        while y != y1:
-            if Pair(y,x)in obs or (((x-x0)**2 + (y-y0)**2 > dis**2) and random.random() > extend_prob):break
-            r.append(Pair(y, x))
-            err -= dx
+        err = ay / 2.0
+        while y != dy:
+            err -= ax
             if err < 0:
                 x += sx
-                err += dy
-            y += sy        
-    r.append(Pair(y,x))
+                err += ay
+            y += sy
+            r.append((y, x))
     return r
 
+class RayTable():
+    '''
+    Every line from the origin to an offset within radius (Chebyshev distance), walked once up front and stored
+    as flat index deltas into an occupancy grid padded by radius OUTSIDE cells on each side. Line of sight and
+    field of view are then index walks over that grid, with no bounds checks and nothing allocated per step.
+    Use get_instance, tables only depend on (radius, height, width).
+    '''
+    def __init__(self, radius, height, width):
+        self.radius = radius
+        self.height = height
+        self.width = width
+        self.stride = width + 2 * radius
+        self.side = 2 * radius + 1
+
+        self.starts = array('i')
+        self.ends = array('i')
+        self.deltas = array('i')
+        self.dist2 = array('i')
+        self.perimeter = []
+        self.rings = {} #r -> the rays out to Chebyshev distance r, see cast
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                if max(abs(dy), abs(dx)) == radius:
+                    self.perimeter.append(len(self.starts))
+                self.starts.append(len(self.deltas))
+                for y, x in _bresenham(dy, dx):
+                    self.deltas.append(y * self.stride + x)
+                    self.dist2.append(y * y + x * x)
+                self.ends.append(len(self.deltas))
+
+    @staticmethod
+    def get_instance(radius, height, width):
+        key = (radius, height, width)
+        if key not in RayTable._instances:
+            RayTable._instances[key] = RayTable(radius, height, width)
+        return RayTable._instances[key]
+
+    def new_grid(self):
+        '''An occupancy grid with every cell of the world OPEN.'''
+        r = self.radius
+        border = bytes([OUTSIDE]) * (r * self.stride + r)
+        row = bytes(self.width) + bytes([OUTSIDE]) * (2 * r)
+        return bytearray(border + row * (self.height - 1) + bytes(self.width) + border)
+
+    def index(self, y, x):
+        return (y + self.radius) * self.stride + x + self.radius
+
+    def pos(self, i):
+        return Pair(i // self.stride - self.radius, i % self.stride - self.radius)
+
+    def line_of_sight(self, grid, y0, x0, y1, x1):
+        '''True if nothing opaque lies strictly between the two cells, None if they are further apart than radius.'''
+        dy, dx = y1 - y0, x1 - x0
+        r = self.radius
+        if abs(dy) > r or abs(dx) > r:
+            return None
+        k = (dy + r) * self.side + dx + r
+        origin = self.index(y0, x0)
+        deltas = self.deltas
+        for i in range(self.starts[k], self.ends[k] - 1):
+            if grid[origin + deltas[i]] != OPEN:
+                return False
+        return True
+
+    def field_of_view(self, grid, y, x, dis=8, extend_prob=.009, rand=random.random):
+        '''
+        Grid indexes seen from (y, x), casting a ray to every offset on the radius perimeter. A ray stops on (and
+        sees) the first opaque cell; past dis it only goes on with probability extend_prob per cell.
+        '''
+        origin = self.index(y, x)
+        seen = {origin}
+        if grid[origin] != OPEN:
+            return seen
+        dis2 = dis * dis
+        starts, ends, deltas, dist2 = self.starts, self.ends, self.deltas, self.dist2
+        for k in self.perimeter:
+            for i in range(starts[k], ends[k]):
+                c = origin + deltas[i]
+                g = grid[c]
+                if g == OUTSIDE:
+                    break
+                seen.add(c)
+                if g or (dist2[i] > dis2 and rand() > extend_prob):
+                    break
+        return seen
+
+    def cast(self, grid, y, x, r):
+        '''
+        Grid index -> squared distance for every cell within r of (y, x) a ray reaches, stopping on (and
+        including) the first opaque cell. Like field_of_view but only walks the rays out to r.
+        '''
+        origin = self.index(y, x)
+        res = {origin:0}
+        if grid[origin] != OPEN:
+            return res
+        r = min(r, self.radius)
+        r2 = r * r
+        ring = self.rings.get(r)
+        if ring is None:
+            R, side = self.radius, self.side
+            ring = self.rings[r] = [(dy + R) * side + dx + R for dy in range(-r, r + 1) for dx in range(-r, r + 1)
+                if max(abs(dy), abs(dx)) == r]
+        starts, ends, deltas, dist2 = self.starts, self.ends, self.deltas, self.dist2
+        for k in ring:
+            for i in range(starts[k], ends[k]):
+                d = dist2[i]
+                if d > r2:
+                    break
+                c = origin + deltas[i]
+                g = grid[c]
+                if g == OUTSIDE:
+                    break
+                res[c] = d
+                if g:
+                    break
+        return res
+
+RayTable._instances = {}
+
 def get_route(start, obs):
 
     prev = {start:None}